@@ -0,0 +1,523 @@
+#!/usr/bin/env python3
+'''
+reading of the annotation (BIDS .tsv or Praat TextGrid) and a columnar,
+binary cache of it
+
+the cache is a directory next to the .tsv (e.g. fg_rscut_ad_ger_speech_
+tagged.tsv.cache/) that contains one .npy file per array and is loaded
+memory-mapped, so that warm runs do not have to parse the text again;
+the word embeddings (last column) are converted into a float32 matrix in
+the same directory when they are requested for the first time
+'''
+import csv
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+
+
+CACHE_VERSION = 1
+# columns that hold numbers; all other columns (except the last one, the
+# word embedding) are stored as integer codes into an array of labels
+NUMERIC_COLUMNS = ['onset', 'duration']
+# dimensions of the word embedding; out-of-vocabulary words (vector of
+# zeroes) are set to '#' in the annotation
+EMBEDDING_DIM = 300
+OOV_FLAG = '#'
+
+# columns of the annotation; rows read from a TextGrid have the same layout
+ANNOTATION_HEADER = ['onset', 'duration', 'person', 'text', 'pos', 'tag',
+                     'dep', 'lemma', 'stop', 'descr', 'vector']
+# tiers of the TextGrid and the flag their rows get in the 'pos' column;
+# intervals of the 'sentences' and 'phonemes' tiers hold the speaker and
+# the text (separated by a tab), intervals of the 'words' tier hold all
+# cells of the row from 'person' on (incl. non-speech and other rows that
+# carry their flag in the 'pos' cell themselves)
+TIER_FLAGS = {'sentences': 'SENTENCE',
+              'words': None,
+              'phonemes': 'PHONEME'}
+
+
+def stream_file(inFile):
+    '''
+    generator that streams the annotation row by row, so that the file never
+    has to be held in memory; the first item it yields is the header
+    '''
+    with open(inFile) as csvfile:
+        content = csv.reader(csvfile, delimiter='\t')
+        yield next(content, None)
+        for line in content:
+            yield line
+
+
+def textgrid_encoding(inFile):
+    '''
+    Praat writes TextGrids either as UTF-8 or as UTF-16 (with BOM)
+    '''
+    with open(inFile, 'rb') as f:
+        bom = f.read(2)
+
+    if bom in [b'\xff\xfe', b'\xfe\xff']:
+        return 'utf-16'
+
+    return 'utf-8-sig'
+
+
+def textgrid_row(flag, xmin, xmax, text):
+    '''
+    converts an interval (or point) of a tier into a row of the annotation
+    '''
+    onset = float(xmin)
+    duration = float(xmax) - onset
+    cells = text.split('\t')
+    if flag is not None:
+        cells = cells[:2] + [flag]
+
+    return [repr(onset), repr(round(duration, 6))] + cells
+
+
+def string_complete(value):
+    '''
+    checks if a (quoted) string of a TextGrid is complete, i.e. if it ends
+    with a quote that is not an escaped ('""') one
+    '''
+    inner = value[1:]
+    trailingQuotes = len(inner) - len(inner.rstrip('"'))
+
+    return trailingQuotes % 2 == 1
+
+
+def stream_textgrid(inFile):
+    '''
+    generator that streams the intervals of a TextGrid (long text format)
+    as rows of the annotation without building the tiers in memory; the
+    first item it yields is the header
+
+    the rows are yielded tier by tier; tiers not listed in TIER_FLAGS and
+    empty intervals are skipped
+    '''
+    yield list(ANNOTATION_HEADER)
+
+    tier = None
+    inItem = False
+    xmin = xmax = None
+    with open(inFile, encoding=textgrid_encoding(inFile)) as f:
+        for line in f:
+            key, sep, value = line.strip().partition(' = ')
+            if not sep:
+                # lines like 'item [1]:' or 'intervals [3]:'
+                inItem = key.startswith(('intervals [', 'points ['))
+                continue
+
+            if key == 'name':
+                tier = value.strip('"').lower()
+            elif not inItem or tier not in TIER_FLAGS:
+                continue
+            elif key in ['xmin', 'number']:
+                xmin = value
+                xmax = value
+            elif key == 'xmax':
+                xmax = value
+            elif key in ['text', 'mark']:
+                # strings may span several lines
+                while not string_complete(value):
+                    value += '\n' + next(f).rstrip()
+                text = value[1:-1].replace('""', '"')
+                if text.strip():
+                    yield textgrid_row(TIER_FLAGS[tier], xmin, xmax, text)
+
+
+def stream_annotation(inFile):
+    '''
+    streams the rows of a .tsv or a .TextGrid (the first item is the header)
+    '''
+    if inFile.lower().endswith('.textgrid'):
+        return stream_textgrid(inFile)
+
+    return stream_file(inFile)
+
+
+def file_hash(inFile, blockSize=2 ** 20):
+    '''
+    '''
+    digest = hashlib.sha1()
+    with open(inFile, 'rb') as f:
+        for block in iter(lambda: f.read(blockSize), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+class AnnotationTable(object):
+    '''
+    the annotation in columnar form
+
+    onset, duration: float64 arrays (duration is NaN for rows without it)
+    length: number of cells of every row
+    codes[column]: int32 array of codes into labels[column]; -1 marks rows
+        that do not have a cell in that column
+    '''
+
+    def __init__(self, header, onset, duration, length, codes, labels):
+        '''
+        '''
+        self.header = header
+        self.onset = onset
+        self.duration = duration
+        self.length = length
+        self.codes = codes
+        self.labels = labels
+
+    def __len__(self):
+        '''
+        '''
+        return len(self.onset)
+
+    def coded_columns(self):
+        '''
+        '''
+        return self.header[len(NUMERIC_COLUMNS):-1]
+
+
+def build_table(rows):
+    '''
+    converts the (streamed) rows of the annotation into an AnnotationTable
+    '''
+    header = next(rows, None)
+    columns = header[len(NUMERIC_COLUMNS):-1]
+    positions = [header.index(column) for column in columns]
+
+    onset = []
+    duration = []
+    length = []
+    codes = {column: [] for column in columns}
+    vocabs = {column: {} for column in columns}
+
+    for line in rows:
+        onset.append(float(line[0]))
+        duration.append(float(line[1]) if len(line) > 1 and line[1] else
+                        np.nan)
+        length.append(len(line))
+        for column, position in zip(columns, positions):
+            if position < len(line):
+                vocab = vocabs[column]
+                code = vocab.setdefault(line[position], len(vocab))
+            else:
+                code = -1
+            codes[column].append(code)
+
+    table = AnnotationTable(
+        header,
+        np.array(onset, dtype=np.float64),
+        np.array(duration, dtype=np.float64),
+        np.array(length, dtype=np.int16),
+        {column: np.array(codes[column], dtype=np.int32)
+         for column in columns},
+        {column: np.array(list(vocabs[column].keys()), dtype=str)
+         for column in columns})
+
+    return table
+
+
+def take_rows(table, rows):
+    '''
+    the table of the given rows (an index array; rows may repeat)
+    '''
+    rows = np.asarray(rows, dtype=np.int64)
+
+    return AnnotationTable(
+        table.header,
+        np.asarray(table.onset)[rows],
+        np.asarray(table.duration)[rows],
+        np.asarray(table.length)[rows],
+        {column: np.asarray(codes)[rows]
+         for column, codes in table.codes.items()},
+        table.labels)
+
+
+def concat_tables(first, second):
+    '''
+    appends the rows of the second table to the first one (same header);
+    the labels of the second table that the first one lacks are appended
+    to its labels
+    '''
+    codes = {}
+    labels = {}
+    for column in first.coded_columns():
+        firstLabels = np.asarray(first.labels[column])
+        secondLabels = np.asarray(second.labels[column])
+        positions = {label: code
+                     for code, label in enumerate(firstLabels.tolist())}
+        newLabels = [label for label in secondLabels.tolist()
+                     if label not in positions]
+        positions.update((label, code) for code, label in
+                         enumerate(newLabels, start=len(firstLabels)))
+        # code -1 (no cell) stays -1
+        remap = np.array([positions[label]
+                          for label in secondLabels.tolist()] + [-1],
+                         dtype=np.int32)
+        codes[column] = np.concatenate([first.codes[column],
+                                        remap[second.codes[column]]])
+        labels[column] = np.concatenate([firstLabels,
+                                         np.array(newLabels, dtype=str)])
+
+    return AnnotationTable(
+        first.header,
+        np.concatenate([first.onset, second.onset]),
+        np.concatenate([first.duration, second.duration]),
+        np.concatenate([first.length, second.length]),
+        codes,
+        labels)
+
+
+def cache_dir(inFile):
+    '''
+    '''
+    return inFile + '.cache'
+
+
+def save_table(table, cacheDir, meta, extra=None):
+    '''
+    writes the arrays of the table and its meta data to the cache directory;
+    extra maps the names of additional files to their content (arrays for
+    .npy files, bytes otherwise), which is replaced together with the table
+    '''
+    tmpDir = cacheDir + '.tmp'
+    shutil.rmtree(tmpDir, ignore_errors=True)
+    os.makedirs(tmpDir)
+
+    np.save(os.path.join(tmpDir, 'onset.npy'), table.onset)
+    np.save(os.path.join(tmpDir, 'duration.npy'), table.duration)
+    np.save(os.path.join(tmpDir, 'length.npy'), table.length)
+    for column in table.coded_columns():
+        np.save(os.path.join(tmpDir, '%s.codes.npy' % column),
+                table.codes[column])
+        np.save(os.path.join(tmpDir, '%s.labels.npy' % column),
+                table.labels[column])
+
+    for fName, content in (extra or {}).items():
+        if fName.endswith('.npy'):
+            np.save(os.path.join(tmpDir, fName), content)
+        else:
+            with open(os.path.join(tmpDir, fName), 'wb') as f:
+                f.write(content)
+
+    meta = dict(meta, version=CACHE_VERSION, header=table.header)
+    with open(os.path.join(tmpDir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    # replace an outdated cache only after the new one is complete
+    shutil.rmtree(cacheDir, ignore_errors=True)
+    os.rename(tmpDir, cacheDir)
+
+
+def read_meta(cacheDir):
+    '''
+    '''
+    try:
+        with open(os.path.join(cacheDir, 'meta.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if meta.get('version') != CACHE_VERSION:
+        return None
+
+    return meta
+
+
+def load_cached_table(cacheDir, meta):
+    '''
+    loads the table memory-mapped from the cache directory
+    '''
+    def load(fName):
+        return np.load(os.path.join(cacheDir, fName), mmap_mode='r')
+
+    header = meta['header']
+    columns = header[len(NUMERIC_COLUMNS):-1]
+    table = AnnotationTable(
+        header,
+        load('onset.npy'),
+        load('duration.npy'),
+        load('length.npy'),
+        {column: load('%s.codes.npy' % column) for column in columns},
+        {column: load('%s.labels.npy' % column) for column in columns})
+
+    return table
+
+
+def load_table(inFile, useCache=True):
+    '''
+    returns the annotation as AnnotationTable; the cache is valid as long
+    as the size and modification time (or, if the file was only touched,
+    the SHA1 hash) of the .tsv are unchanged
+    '''
+    if not useCache:
+        return build_table(stream_annotation(inFile))
+
+    cacheDir = cache_dir(inFile)
+    stat = os.stat(inFile)
+    fileInfo = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+    meta = read_meta(cacheDir)
+    if meta is not None and meta['size'] == fileInfo['size']:
+        if meta['mtime'] == fileInfo['mtime']:
+            return load_cached_table(cacheDir, meta)
+
+        # file was touched; check if its content actually changed
+        digest = file_hash(inFile)
+        if meta['sha1'] == digest:
+            meta.update(fileInfo)
+            try:
+                with open(os.path.join(cacheDir, 'meta.json'), 'w') as f:
+                    json.dump(meta, f)
+            except OSError:
+                pass
+            return load_cached_table(cacheDir, meta)
+
+    table = build_table(stream_annotation(inFile))
+    meta = dict(fileInfo, sha1=file_hash(inFile))
+    try:
+        save_table(table, cacheDir, meta)
+    except OSError:
+        # e.g. the directory of the annotation is read-only
+        pass
+
+    return table
+
+
+class WordEmbeddings(object):
+    '''
+    the word embeddings of the annotation
+
+    vectors: float32 matrix (words x 300), one row per row of the annotation
+        that has a cell in the embedding column
+    oov: bool array marking the out-of-vocabulary words (vector of zeroes)
+    rows: int64 array of the rows (in the .tsv and AnnotationTable) the
+        vectors belong to
+    '''
+
+    def __init__(self, vectors, oov, rows):
+        '''
+        '''
+        self.vectors = vectors
+        self.oov = oov
+        self.rows = rows
+
+    def __len__(self):
+        '''
+        '''
+        return len(self.rows)
+
+    def lookup(self, tableRows):
+        '''
+        returns the vectors of the given rows of the annotation (which must
+        be rows with an embedding)
+        '''
+        tableRows = np.asarray(tableRows, dtype=np.int64)
+        index = np.searchsorted(self.rows, tableRows)
+        index = np.minimum(index, len(self.rows) - 1)
+        if not np.array_equal(self.rows[index], tableRows):
+            raise ValueError('rows without a word embedding requested')
+
+        return self.vectors[index]
+
+
+def parse_vector(cell):
+    '''
+    converts the text of an embedding cell into a float32 array
+    '''
+    cell = cell.strip().strip('[]').replace(',', ' ')
+    vector = np.array(cell.split(), dtype=np.float32)
+    if vector.shape != (EMBEDDING_DIM, ):
+        raise ValueError('expected a vector with %i dimensions, got %i'
+                         % (EMBEDDING_DIM, vector.size))
+
+    return vector
+
+
+def embedding_rows(table):
+    '''
+    rows of the annotation that have a cell in the last column (the
+    embedding)
+    '''
+    return np.flatnonzero(np.asarray(table.length) >= len(table.header))
+
+
+def fill_embeddings(inFile, table, vectors):
+    '''
+    streams the annotation once and writes the embedding cells into the
+    given matrix (one row per row returned by embedding_rows); returns the
+    OOV mask
+    '''
+    oov = np.zeros(len(vectors), dtype=bool)
+
+    position = len(table.header) - 1
+    content = stream_annotation(inFile)
+    next(content, None)
+    index = 0
+    for line in content:
+        if len(line) <= position:
+            continue
+        cell = line[position]
+        if cell.strip() in [OOV_FLAG, '']:
+            oov[index] = True
+        else:
+            vectors[index] = parse_vector(cell)
+        index += 1
+
+    return oov
+
+
+def build_embeddings(inFile, table, cacheDir):
+    '''
+    writes the embedding column as float32 matrix (plus the OOV mask and
+    the row indices) into the cache directory
+    '''
+    rows = embedding_rows(table)
+
+    vectorsFile = os.path.join(cacheDir, 'vector.npy')
+    tmpFile = os.path.join(cacheDir, 'vector.tmp.npy')
+    vectors = np.lib.format.open_memmap(tmpFile, mode='w+',
+                                        dtype=np.float32,
+                                        shape=(len(rows), EMBEDDING_DIM))
+    oov = fill_embeddings(inFile, table, vectors)
+
+    vectors.flush()
+    del vectors
+    np.save(os.path.join(cacheDir, 'vector.oov.npy'), oov)
+    np.save(os.path.join(cacheDir, 'vector.rows.npy'), rows)
+    # the matrix is moved into place last, since it marks a complete build
+    os.replace(tmpFile, vectorsFile)
+
+
+def load_embeddings(inFile):
+    '''
+    returns the (memory-mapped) WordEmbeddings of the annotation; they are
+    extracted from the .tsv only if the cache does not contain them yet (and
+    are held in memory if the cache cannot be written)
+    '''
+    # makes sure that the cache directory is valid for the current file
+    table = load_table(inFile)
+
+    cacheDir = cache_dir(inFile)
+    vectorsFile = os.path.join(cacheDir, 'vector.npy')
+    if not os.path.exists(vectorsFile):
+        try:
+            build_embeddings(inFile, table, cacheDir)
+        except OSError:
+            # no (writable) cache directory, e.g. the directory of the
+            # annotation is read-only; the embeddings are held in memory
+            rows = embedding_rows(table)
+            vectors = np.zeros((len(rows), EMBEDDING_DIM), dtype=np.float32)
+            oov = fill_embeddings(inFile, table, vectors)
+
+            return WordEmbeddings(vectors, oov, rows)
+
+    embeddings = WordEmbeddings(
+        np.load(vectorsFile, mmap_mode='r'),
+        np.load(os.path.join(cacheDir, 'vector.oov.npy'), mmap_mode='r'),
+        np.load(os.path.join(cacheDir, 'vector.rows.npy'), mmap_mode='r'))
+
+    return embeddings
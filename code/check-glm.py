@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+'''
+checks fit-glm.py on synthetic data: plants an effect of the words (all
+'tag' regressors) in a cube of small 4-D NIfTI volumes of some subjects and
+runs, fits the GLM and checks that the z-maps of words > no-speech recover
+the cube (and that no-speech > words does not)
+'''
+from tempfile import TemporaryDirectory
+import argparse
+import nibabel as nib
+import numpy as np
+import os
+import subprocess
+import sys
+from design import build_designs, layout_columns, read_ev3_dir
+from glm import COPE_DIR, threshold_name
+from regressors import REGISTRY_FILE, load_registry
+
+
+# voxels of the volumes and the cube that gets the effect
+SHAPE = (12, 12, 8)
+CUBE = (slice(3, 8), slice(3, 8), slice(2, 6))
+
+
+def parse_arguments():
+    '''
+    '''
+    parser = argparse.ArgumentParser(
+        description='checks the GLM on synthetic data with a planted effect'
+    )
+    parser.add_argument('-s',
+                        type=int,
+                        default=6,
+                        help='number of subjects')
+
+    parser.add_argument('-n',
+                        type=int,
+                        default=3,
+                        help='number of runs per subject')
+
+    parser.add_argument('-v',
+                        type=int,
+                        default=150,
+                        help='number of volumes per run')
+
+    parser.add_argument('-t',
+                        type=float,
+                        default=3.4,
+                        help='z threshold')
+
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0,
+                        help='seed of the synthetic events and noise')
+
+    args = parser.parse_args()
+
+    nrOfSubjects = args.s
+    nrOfRuns = args.n
+    nrOfVolumes = args.v
+    threshold = args.t
+    seed = args.seed
+
+    return nrOfSubjects, nrOfRuns, nrOfVolumes, threshold, seed
+
+
+def write_events(evDir, registry, nrOfRuns, nrOfVolumes, rng, tr=2.0):
+    '''
+    writes random events (EV3 files) of every regressor and run
+    '''
+    for run in range(1, nrOfRuns + 1):
+        os.makedirs(os.path.join(evDir, 'run-%i' % run), exist_ok=True)
+        for name in registry.eventFiles:
+            nrOfEvents = rng.integers(5, 30)
+            onsets = np.sort(rng.uniform(0, nrOfVolumes * tr - 20,
+                                         nrOfEvents))
+            durations = rng.uniform(0.5, 3.0, nrOfEvents)
+            np.savetxt(os.path.join(evDir, 'run-%i' % run, '%s.txt' % name),
+                       np.column_stack([onsets, durations,
+                                        np.ones(nrOfEvents)]),
+                       fmt='%.3f', delimiter='\t')
+
+
+def write_bold(fpath, design, wordColumns, amplitude, rng):
+    '''
+    writes a 4-D volume of noise whose cube follows the sum of the words'
+    regressors (scaled by the amplitude)
+    '''
+    data = 100 + rng.standard_normal(SHAPE + (len(design),))
+    signal = design[:, wordColumns].sum(axis=1)
+    data[CUBE] += amplitude * (signal - signal.mean())
+    nib.save(nib.Nifti1Image(data.astype(np.float32), np.eye(4)), fpath)
+
+
+if __name__ == "__main__":
+    nrOfSubjects, nrOfRuns, nrOfVolumes, threshold, seed = parse_arguments()
+
+    rng = np.random.default_rng(seed)
+    registry = load_registry(REGISTRY_FILE)
+    wordColumns = registry.designColumns[registry.groups == 'tag']
+
+    with TemporaryDirectory() as tmpDir:
+        evDir = os.path.join(tmpDir, 'events')
+        write_events(evDir, registry, nrOfRuns, nrOfVolumes, rng)
+        runEvents = read_ev3_dir(evDir, registry.eventFiles, nrOfRuns)
+
+        for subject in range(1, nrOfSubjects + 1):
+            subjDir = os.path.join(tmpDir, 'sub-%02i' % subject)
+            os.makedirs(subjDir)
+            # the effect varies a little across subjects
+            amplitude = 10.0 + rng.standard_normal()
+            for run in range(1, nrOfRuns + 1):
+                design = layout_columns(
+                    build_designs([runEvents[run - 1]], [nrOfVolumes])[0],
+                    registry.designColumns)
+                write_bold(os.path.join(subjDir, 'sub-%02i_run-%i_bold.nii'
+                                        % (subject, run)),
+                           design, wordColumns, amplitude, rng)
+
+        outDir = os.path.join(tmpDir, 'glm')
+        subprocess.run([sys.executable,
+                        os.path.join(os.path.dirname(
+                            os.path.abspath(__file__)), 'fit-glm.py'),
+                        '-b', os.path.join(tmpDir, 'sub-*',
+                                           'sub-*_run-?_bold.nii'),
+                        '-ev', evDir,
+                        '-o', outDir,
+                        '-t', str(threshold),
+                        '-j', '1'],
+                       check=True)
+
+        inCube = np.zeros(SHAPE, dtype=bool)
+        inCube[CUBE] = True
+        failed = False
+        for cope, expected in [(1, True), (2, False)]:
+            fpath = os.path.join(outDir, '3rd-lvl',
+                                 COPE_DIR % (cope, threshold_name(threshold)),
+                                 'cope1.feat', 'thresh_zstat1.nii.gz')
+            detected = np.asarray(nib.load(fpath).dataobj) > threshold
+            hits = detected[inCube].mean()
+            falseAlarms = detected[~inCube].mean()
+            print('cope%i: %.0f%% of the cube, %.1f%% outside above z=%s' %
+                  (cope, 100 * hits, 100 * falseAlarms, threshold))
+
+            if expected and hits < 0.9 or not expected and hits > 0 \
+                    or falseAlarms > 0.01:
+                failed = True
+
+    if failed:
+        raise SystemExit('the planted effect was not recovered')
+    print('the planted effect was recovered')
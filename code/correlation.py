@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+'''
+Pearson correlation of regressors accumulated chunk by chunk (e.g. one
+design file after another), so that the time series never have to be
+concatenated in memory
+'''
+import numpy as np
+
+
+class StreamingCorrelation(object):
+    '''
+    accumulates the number of samples, the sums and the cross-products of
+    the columns in float64; memory is O(columns^2) regardless of the
+    number of samples
+
+    the sums are taken around a shift (the mean of the first chunk), which
+    keeps the cross-products from cancelling out numerically
+    '''
+
+    def __init__(self, nrOfColumns):
+        '''
+        '''
+        self.n = 0
+        self.shift = None
+        self.sums = np.zeros(nrOfColumns, dtype=np.float64)
+        self.products = np.zeros((nrOfColumns, nrOfColumns), dtype=np.float64)
+
+    def update(self, chunk):
+        '''
+        adds a chunk of samples (samples x columns)
+        '''
+        chunk = np.asarray(chunk, dtype=np.float64)
+        if len(chunk) == 0:
+            return self
+
+        if self.shift is None:
+            self.shift = chunk.mean(axis=0)
+
+        centered = chunk - self.shift
+        self.n += len(chunk)
+        self.sums += centered.sum(axis=0)
+        self.products += centered.T @ centered
+
+        return self
+
+    def merge(self, other):
+        '''
+        adds the samples accumulated by another StreamingCorrelation
+        '''
+        if other.n == 0:
+            return self
+        if self.shift is None:
+            self.shift = other.shift.copy()
+
+        # move the other's sums from its shift to this shift
+        delta = other.shift - self.shift
+        self.products += other.products \
+            + np.outer(delta, other.sums) + np.outer(other.sums, delta) \
+            + other.n * np.outer(delta, delta)
+        self.sums += other.sums + other.n * delta
+        self.n += other.n
+
+        return self
+
+    def covariance(self):
+        '''
+        '''
+        means = self.sums / self.n
+
+        return (self.products - self.n * np.outer(means, means)) / \
+            (self.n - 1)
+
+    def correlation(self):
+        '''
+        Pearson correlation matrix of the columns
+        '''
+        covariance = self.covariance()
+        std = np.sqrt(np.diag(covariance))
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return covariance / np.outer(std, std)
+
+
+def collinearity(corrMat, configs):
+    '''
+    variance inflation factors, condition numbers and eigenvalues of the
+    (standardized) design for every configuration; configs maps the name of
+    a configuration to a boolean mask of the columns it uses
+
+    columns without variance (e.g. regressors without events) have no
+    correlations; they are dropped from every configuration, and the
+    diagnostics are computed on the remaining columns
+
+    all configurations with the same number of columns are decomposed in one
+    batched eigendecomposition of their correlation matrices; returns the
+    VIFs (configurations x columns, NaN for unused and dropped columns), the
+    condition numbers, a dict of the eigenvalues (descending) of every
+    config and the masks (configurations x columns) of the dropped columns
+    '''
+    corrMat = np.asarray(corrMat, dtype=np.float64)
+    masks = np.array([mask for mask in configs.values()], dtype=bool)
+    dropped = masks & np.isnan(np.diag(corrMat))
+    masks = masks & ~dropped
+    vifs = np.full(masks.shape, np.nan)
+    conditions = np.full(len(masks), np.nan)
+    spectra = [None] * len(masks)
+
+    for nrOfColumns in np.unique(masks.sum(axis=1)):
+        configIdx = np.flatnonzero(masks.sum(axis=1) == nrOfColumns)
+        columns = np.array([np.flatnonzero(masks[i]) for i in configIdx])
+        # configs x columns x columns
+        subMats = corrMat[columns[:, :, np.newaxis], columns[:, np.newaxis, :]]
+        # any other undefined correlation invalidates the configuration
+        valid = ~np.isnan(subMats).any(axis=(1, 2))
+        subMats[~valid] = np.eye(nrOfColumns)
+
+        eigVals, eigVecs = np.linalg.eigh(subMats)
+        # numerically, a singular matrix might have tiny negative eigenvalues
+        eigVals = np.maximum(eigVals, 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # the diagonal of the inverse from its eigendecomposition
+            subVifs = (eigVecs ** 2 / eigVals[:, np.newaxis, :]).sum(axis=2)
+            subConditions = np.sqrt(eigVals[:, -1] / eigVals[:, 0])
+        subVifs[~valid] = np.nan
+        subConditions[~valid] = np.nan
+
+        for i, config in enumerate(configIdx):
+            vifs[config, columns[i]] = subVifs[i]
+            conditions[config] = subConditions[i]
+            spectra[config] = eigVals[i, ::-1] if valid[i] else \
+                np.full(nrOfColumns, np.nan)
+
+    return vifs, conditions, dict(zip(configs.keys(), spectra)), dropped
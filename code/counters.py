@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+'''
+array-backed counters for the descriptive statistics of the annotation
+'''
+from array import array
+import numpy as np
+
+
+# column 0 holds the count for the whole stimulus, columns 1-8 the counts of
+# the eight segments
+NR_OF_COLUMNS = 9
+# number of buffered increments that triggers a vectorized update of the array
+FLUSH_SIZE = 2 ** 16
+
+
+class CountStore(object):
+    '''
+    counts of the categories (e.g. speakers, phonemes, or labels of a
+    column) of an annotation for the whole stimulus and every segment
+
+    categories are interned to integer codes (in order of their first
+    occurrence); the counts are held in a 2-D array of shape categories x 9
+    '''
+
+    def __init__(self):
+        '''
+        '''
+        self.codes = {}
+        self.labels = []
+        self._counts = np.zeros((0, NR_OF_COLUMNS), dtype=np.int64)
+        # increments are buffered and added to the array in batches
+        self._pendCodes = array('l')
+        self._pendSegments = array('l')
+
+    def __len__(self):
+        '''
+        '''
+        return len(self.labels)
+
+    def intern(self, category):
+        '''
+        returns the code of a category (and assigns one to a new category)
+        '''
+        code = self.codes.get(category)
+        if code is None:
+            code = len(self.labels)
+            self.codes[category] = code
+            self.labels.append(category)
+
+        return code
+
+    def add(self, category, segment):
+        '''
+        increases the count of a category for the whole stimulus and the
+        given segment (1-8) by one
+        '''
+        self._pendCodes.append(self.intern(category))
+        self._pendSegments.append(segment)
+        if len(self._pendCodes) >= FLUSH_SIZE:
+            self.flush()
+
+    def add_many(self, labels, codes, segments):
+        '''
+        vectorized version of add: increases the counts of the categories
+        labels[codes] for the given segments by one
+        '''
+        codes = np.asarray(codes, dtype=np.int64)
+        segments = np.asarray(segments, dtype=np.int64)
+
+        # intern the categories in the order of their first occurrence
+        present, first = np.unique(codes, return_index=True)
+        present = present[np.argsort(first, kind='stable')]
+        remap = np.zeros(len(labels), dtype=np.int64)
+        for code in present.tolist():
+            remap[code] = self.intern(str(labels[code]))
+
+        self.flush()
+        self._add_codes(remap[codes], segments)
+
+    def merge(self, other):
+        '''
+        adds the counts of another CountStore (e.g. of another annotation);
+        its new categories are appended in their order
+        '''
+        remap = np.array([self.intern(label) for label in other.labels],
+                         dtype=np.int64)
+        otherCounts = other.counts
+
+        self.flush()
+        self._counts[remap] += otherCounts
+
+        return self
+
+    def subtract(self, other):
+        '''
+        removes the counts of another CountStore (e.g. of rows that were
+        deleted from the annotation); call prune() afterwards to drop the
+        categories that do not occur anymore
+        '''
+        remap = np.array([self.intern(label) for label in other.labels],
+                         dtype=np.int64)
+        otherCounts = other.counts
+
+        self.flush()
+        self._counts[remap] -= otherCounts
+
+        return self
+
+    def prune(self):
+        '''
+        drops the categories whose count for the whole stimulus is zero
+        '''
+        counts = self.counts
+        keep = np.flatnonzero(counts[:, 0] != 0)
+        self.labels = [self.labels[code] for code in keep.tolist()]
+        self.codes = {label: code for code, label in enumerate(self.labels)}
+        self._counts = counts[keep]
+
+        return self
+
+    def flush(self):
+        '''
+        adds all buffered increments to the array of counts
+        '''
+        if len(self._pendCodes) == 0:
+            self._add_codes(np.zeros(0, dtype=np.int64),
+                            np.zeros(0, dtype=np.int64))
+            return None
+
+        codes = np.frombuffer(self._pendCodes, dtype=self._pendCodes.typecode)
+        segments = np.frombuffer(self._pendSegments,
+                                 dtype=self._pendSegments.typecode)
+        self._add_codes(codes, segments)
+
+        del codes, segments
+        self._pendCodes = array('l')
+        self._pendSegments = array('l')
+
+        return None
+
+    def _add_codes(self, codes, segments):
+        '''
+        adds the counts of the (already interned) codes to the array
+        '''
+        nrOfCategories = len(self.labels)
+        if nrOfCategories > self._counts.shape[0]:
+            grown = np.zeros((nrOfCategories, NR_OF_COLUMNS), dtype=np.int64)
+            grown[:self._counts.shape[0]] = self._counts
+            self._counts = grown
+
+        if len(codes) == 0:
+            return None
+
+        # count for the whole stimulus
+        self._counts[:, 0] += np.bincount(codes, minlength=nrOfCategories)
+        # counts for the segments; events after the movie's last time point
+        # only count for the whole stimulus
+        inSegment = (segments >= 1) & (segments < NR_OF_COLUMNS)
+        flat = codes[inSegment] * NR_OF_COLUMNS + segments[inSegment]
+        perSegment = np.bincount(flat,
+                                 minlength=nrOfCategories * NR_OF_COLUMNS)
+        self._counts += perSegment.reshape(nrOfCategories, NR_OF_COLUMNS)
+
+        return None
+
+    @property
+    def counts(self):
+        '''
+        array of shape categories x 9 (whole stimulus, segments 1-8)
+        '''
+        self.flush()
+
+        return self._counts
+
+    def total(self):
+        '''
+        total count of all categories for the whole stimulus
+        '''
+        return int(self.counts[:, 0].sum())
+
+    def per_run(self):
+        '''
+        counts of all categories summed for the whole stimulus and every
+        segment
+        '''
+        return self.counts.sum(axis=0)
+
+    def ranked(self, exclude=()):
+        '''
+        codes of the categories sorted from most to least often occurring
+        category in the whole stimulus; ties keep the order of occurrence
+        '''
+        counts = self.counts[:, 0]
+        order = np.argsort(-counts, kind='stable')
+        if exclude:
+            excluded = [self.codes[label] for label in exclude
+                        if label in self.codes]
+            order = order[~np.isin(order, excluded)]
+
+        return order
+
+    def rows(self, codes):
+        '''
+        returns a list [category, count all, count segment 1, ...] for
+        every given code
+        '''
+        codes = np.asarray(codes, dtype=np.int64)
+        counts = self.counts[codes].tolist()
+
+        return [[self.labels[code]] + count
+                for code, count in zip(codes.tolist(), counts)]
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+'''
+creates the EV3 files (onset, duration, amplitude) of the speech-related
+regressors for all eight segments/runs from the annotation
+'''
+from annotation import load_table
+from segments import SEGMENTS_OFFSETS, SegmentIndex
+import argparse
+import numpy as np
+import os
+
+
+# number of segments/runs of the stimulus
+NR_OF_RUNS = 8
+
+# no-speech events: minimum length of the intervals without speech they are
+# placed in, minimum distance of their onsets to any onset or offset of a
+# word and to each other, and their duration (the average phoneme length)
+NO_SPEECH_GAP = 3.6
+NO_SPEECH_DISTANCE = 1.8
+NO_SPEECH_DURATION = 0.07
+
+
+def parse_arguments():
+    '''
+    '''
+    parser = argparse.ArgumentParser(
+        description='creates the EV3 files of all regressors for all runs'
+    )
+    parser.add_argument('-i',
+                        default='annotation/fg_rscut_ad_ger_speech_tagged.tsv',
+                        help='the annotation (.tsv or .TextGrid)')
+
+    parser.add_argument('-o',
+                        default='events/onsets',
+                        help='the output directory (one directory per run)')
+
+    parser.add_argument('--tags',
+                        type=int,
+                        default=20,
+                        help='number of most often occurring tag labels that '
+                        'get their own regressor; all others are pooled')
+
+    parser.add_argument('--phones',
+                        type=int,
+                        default=80,
+                        help='number of most often occurring phonemes that are '
+                        'pooled to the phoneme regressor')
+
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0,
+                        help='seed of the random positions of the no-speech '
+                        'events')
+
+    parser.add_argument('--no-cache',
+                        action='store_true',
+                        help='do not use the binary cache of the annotation')
+
+    args = parser.parse_args()
+
+    inFile = args.i
+    outDir = args.o
+    topTags = args.tags
+    topPhones = args.phones
+    seed = args.seed
+    useCache = not args.no_cache
+
+    return inFile, outDir, topTags, topPhones, seed, useCache
+
+
+def flagged_rows(table, flag):
+    '''
+    rows that carry the flag (e.g. 'SENTENCE') in the 'pos' column
+    '''
+    posColumn = table.header[4]
+    isFlagged = [flag in label for label in table.labels[posColumn].tolist()]
+
+    return np.array(isFlagged + [False])[table.codes[posColumn]]
+
+
+def most_frequent(codes, labels, topNr):
+    '''
+    codes of the topNr most often occurring labels (ties keep the order
+    of the labels)
+    '''
+    counts = np.bincount(codes, minlength=len(labels))
+    order = np.argsort(-counts, kind='stable')
+    order = order[counts[order] > 0]
+
+    return order[:topNr]
+
+
+def no_speech_onsets(onsets, offsets, rng, end=SEGMENTS_OFFSETS[-1][0]):
+    '''
+    random onsets in the intervals without speech (words and non-speech
+    vocalizations given by their onsets and offsets) that last at least
+    NO_SPEECH_GAP; every onset keeps NO_SPEECH_DISTANCE to the speech (and
+    to the start and end of the stimulus) and to the other onsets, and as
+    many onsets as fit are placed into every interval
+    '''
+    order = np.argsort(onsets, kind='stable')
+    onsets = np.concatenate([onsets[order], [end]])
+    # end of the speech before every interval (speech might overlap)
+    offsets = np.maximum.accumulate(np.concatenate([[0.0], offsets[order]]))
+
+    gaps = onsets - offsets
+    isGap = gaps >= NO_SPEECH_GAP
+    starts = offsets[isGap] + NO_SPEECH_DISTANCE
+    lengths = gaps[isGap] - 2 * NO_SPEECH_DISTANCE
+
+    # n onsets with the minimum distance fit into an interval, if the sum
+    # of the distances between them does not exceed its length; the
+    # remaining slack is distributed randomly between them
+    counts = np.floor(lengths / NO_SPEECH_DISTANCE).astype(int) + 1
+    slacks = lengths - (counts - 1) * NO_SPEECH_DISTANCE
+    gapIds = np.repeat(np.arange(len(counts)), counts)
+    randoms = rng.uniform(0, slacks[gapIds])
+    randoms = randoms[np.lexsort((randoms, gapIds))]
+    ranks = np.arange(len(gapIds)) - np.repeat(np.cumsum(counts) - counts,
+                                               counts)
+
+    return starts[gapIds] + randoms + ranks * NO_SPEECH_DISTANCE
+
+
+def build_events(table, topTags, topPhones, rng):
+    '''
+    returns the names of the regressors and, for every event, the index of
+    its regressor, its onset and its duration (in seconds from stimulus
+    onset); rng positions the no-speech events
+    '''
+    onsets = np.asarray(table.onset)
+    durations = np.nan_to_num(np.asarray(table.duration))
+
+    isSent = flagged_rows(table, 'SENTENCE')
+    isNonSpeech = flagged_rows(table, 'NONSPEECH') & ~isSent
+    isPhone = flagged_rows(table, 'PHONEME') & ~isSent & ~isNonSpeech
+
+    # words are rows with a tag; labels that cannot be a file name
+    # (e.g. punctuation) never get their own regressor
+    tagColumn = table.header[5]
+    tagCodes = np.asarray(table.codes[tagColumn])
+    tagLabels = table.labels[tagColumn].tolist()
+    isWord = (np.asarray(table.length) >= 6) & (tagCodes >= 0) \
+        & ~isSent & ~isNonSpeech & ~isPhone
+    isWord[isWord] = np.array([label != '' for label in tagLabels]
+                              )[tagCodes[isWord]]
+    nameable = np.array([label.isalnum() for label in tagLabels])
+    wordCodes = tagCodes[isWord]
+    topTagCodes = most_frequent(wordCodes[nameable[wordCodes]],
+                                tagLabels, topTags)
+
+    # phonemes
+    phoneColumn = table.header[3]
+    phoneCodes = np.asarray(table.codes[phoneColumn])
+    topPhoneCodes = most_frequent(phoneCodes[isPhone],
+                                  table.labels[phoneColumn], topPhones)
+
+    # regressor of every tag label (tag_other if not among the top labels)
+    names = [tagLabels[code].lower() for code in topTagCodes.tolist()]
+    names.extend(['tag_other', 'sentence', 'phones', 'no-sp'])
+    tagRegressor = np.full(len(tagLabels), names.index('tag_other'))
+    tagRegressor[topTagCodes] = np.arange(len(topTagCodes))
+
+    isTopPhone = isPhone & np.isin(phoneCodes, topPhoneCodes)
+
+    # no-speech events lie between the audible speech, i.e. words and
+    # non-speech vocalizations
+    isSpeech = ~isSent & ~isPhone
+    noSpeechOnsets = no_speech_onsets(onsets[isSpeech],
+                                      onsets[isSpeech] + durations[isSpeech],
+                                      rng)
+
+    regressors = np.concatenate([
+        tagRegressor[wordCodes],
+        np.full(isSent.sum(), names.index('sentence')),
+        np.full(isTopPhone.sum(), names.index('phones')),
+        np.full(len(noSpeechOnsets), names.index('no-sp'))])
+    # sentence endings are modeled as impulses
+    eventOnsets = np.concatenate([
+        onsets[isWord],
+        onsets[isSent] + durations[isSent],
+        onsets[isTopPhone],
+        noSpeechOnsets])
+    eventDurations = np.concatenate([
+        durations[isWord],
+        np.zeros(isSent.sum()),
+        durations[isTopPhone],
+        np.full(len(noSpeechOnsets), NO_SPEECH_DURATION)])
+
+    return names, regressors, eventOnsets, eventDurations
+
+
+def write_event_files(outDir, names, regressors, runs, onsets, durations):
+    '''
+    writes one EV3 file per regressor and run (also if it has no events)
+    '''
+    # sort by regressor, run, and onset to get one block per file
+    order = np.lexsort((onsets, runs, regressors))
+    fileIds = regressors[order] * NR_OF_RUNS + (runs[order] - 1)
+    bounds = np.searchsorted(fileIds, np.arange(len(names) * NR_OF_RUNS + 1))
+    events = np.column_stack([onsets[order],
+                              durations[order],
+                              np.ones(len(order))])
+
+    for run in range(1, NR_OF_RUNS + 1):
+        os.makedirs(os.path.join(outDir, 'run-%i' % run), exist_ok=True)
+
+    for regressor, name in enumerate(names):
+        for run in range(1, NR_OF_RUNS + 1):
+            fileId = regressor * NR_OF_RUNS + run - 1
+            block = events[bounds[fileId]:bounds[fileId + 1]]
+            fpath = os.path.join(outDir, 'run-%i' % run, '%s.txt' % name)
+            np.savetxt(fpath, block, fmt='%.3f', delimiter='\t')
+
+
+if __name__ == "__main__":
+    inFile, outDir, topTags, topPhones, seed, useCache = parse_arguments()
+
+    # read the annotation once
+    table = load_table(inFile, useCache)
+
+    names, regressors, onsets, durations = build_events(
+        table, topTags, topPhones, np.random.default_rng(seed))
+
+    # split the events into the segments and make their onsets relative to
+    # the start of their segment; events after the movie's last time
+    # point are dropped
+    segmIndex = SegmentIndex()
+    runs = segmIndex.segments(onsets)
+    inRun = runs <= NR_OF_RUNS
+    regressors, runs = regressors[inRun], runs[inRun]
+    onsets = segmIndex.run_onsets(onsets[inRun], runs)
+    durations = durations[inRun]
+
+    write_event_files(outDir, names, regressors, runs, onsets, durations)
@@ -3,23 +3,25 @@
 author: Christian Olaf Haeusler
 created on Friday October 22th 2019
 """
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+from itertools import chain, repeat
 import argparse
 import csv
-import spacy
+import hashlib
+import json
+import numpy as np
+import os.path
+import pickle
+from annotation import (build_table, concat_tables, load_cached_table,
+                        load_table, read_meta,
+                        save_table, stream_annotation, take_rows)
 from collections import defaultdict
+from counters import CountStore
+from glossary import explain
+from segments import SegmentIndex
 
 
-SEGMENTS_OFFSETS = (
-    (0.00, 0.00),
-    (886.00, 0.00),
-    (1752.08, 0.08),  # third segment's start
-    (2612.16, 0.16),
-    (3572.20, 0.20),
-    (4480.28, 0.28),
-    (5342.36, 0.36),
-    (6410.44, 0.44),  # last segment's start
-    (7086.00, 0.00))  # movie's last time point
-
 no2alpha = {0: 'All',
             1: 'I',
             2: 'II',
@@ -40,122 +42,414 @@ def parse_arguments():
     )
     parser.add_argument('-i',
                         default='annotation/fg_rscut_ad_ger_speech_tagged.tsv',
-                        help='The input file')
+                        help='The input file (.tsv or .TextGrid); a '
+                        'directory (all .tsv files in it) or a quoted glob '
+                        'pattern of several input files is counted per '
+                        'file & combined')
 
     parser.add_argument('-o',
                         required=False,
                         default=None,
-                        help='the tex-file the statistics to write to')
+                        help='the tex-file the statistics to write to; '
+                        'for several input files, the per-file statistics '
+                        'are written next to it (<name>-<input>.tex)')
+
+    parser.add_argument('-j',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='number of processes counting several input '
+                        'files in parallel')
+
+    parser.add_argument('--no-cache',
+                        action='store_true',
+                        help='stream the .tsv instead of using (and '
+                        'creating) the binary cache next to it')
+
+    parser.add_argument('--incremental',
+                        action='store_true',
+                        help='update the counts of the last run (stored '
+                        'in <input>.state) with the rows that were added, '
+                        'removed or changed since then')
 
     args = parser.parse_args()
 
-    inFile = args.i
+    inPattern = args.i
     outFile = args.o
+    useCache = not args.no_cache
+    nrOfWorkers = args.j
+    incremental = args.incremental
 
-    return inFile, outFile
+    return inPattern, outFile, useCache, nrOfWorkers, incremental
 
 
-def read_file(inFile):
+def find_input_files(inPattern):
     '''
+    returns the annotation files for a file, a directory or a glob pattern
     '''
-    with open(inFile) as csvfile:
-        content = csv.reader(csvfile, delimiter='\t')
-        header = next(content, None)
-        content = [x for x in content]
+    if os.path.isfile(inPattern):
+        return [inPattern]
+
+    if os.path.isdir(inPattern):
+        inPattern = os.path.join(inPattern, '**', '*.tsv')
 
-    return header, content
+    inFiles = sorted(fpath for fpath in glob(inPattern, recursive=True)
+                     if os.path.isfile(fpath))
+    if not inFiles:
+        raise FileNotFoundError('no annotation found for %s' % inPattern)
 
+    return inFiles
 
-def get_run_number(starts, onset):
+
+def populate_name_count(sent, nonSpeech, phones, line, segment):
     '''
     '''
-    for start in sorted(starts, reverse=True):
-        if float(onset) >= start:
-            run = starts.index(start)
-            break
+    # does the row contain a sentence?
+    if 'SENTENCE' in line[4]:
+        # counter for the whole stimulus and the segment
+        sent.add(line[2], segment)
+    elif 'NONSPEECH' in line[4]:
+        nonSpeech.add(line[2], segment)
+    elif 'PHONEME' in line[4]:
+        phones.add(line[3], segment)
+    else:
+        # column entry belongs to POS tagging of single words
+        pass
 
-    return run
+    return sent, nonSpeech, phones
 
 
-def populate_name_count(sent, nonSpeech, phones, data):
+def compile_row_schema(header):
     '''
+    resolves the positions of the words' columns in the header once;
+    returns a list that maps the length of a row to the cells that have to
+    be counted as (column, position, split at ';') triplets
     '''
-    segmStarts = [start for start, offset in SEGMENTS_OFFSETS]
-
-    for line in data:
-        # check the run/segment we are in
-        run = get_run_number(segmStarts, line[0])
-        segment = str(run + 1)
-
-        # does the row contain a sentence?
-        if 'SENTENCE' in line[4]:
-            # counter for the whole stimulus (key=0)
-            sent[line[2]]['0'] += 1
-            # counter for the segments
-            sent[line[2]][segment] += 1
-        elif 'NONSPEECH' in line[4]:
-            nonSpeech[line[2]]['0'] += 1
-            nonSpeech[line[2]][segment] += 1
-        elif 'PHONEME' in line[4]:
-            phones[line[3]][segment] += 1
-            phones[line[3]]['0'] += 1
+    wordColumns = [(column, header.index(column), column in ['dep', 'descr'])
+                   for column in header[2:-1]]
+
+    # only rows with at least 6 columns contain a word; NON-SPECH and
+    # X, XY (=other) have 6 not 11 columns, so they get only the cells
+    # that are within their length
+    schema = []
+    for length in range(0, len(header) + 1):
+        if length < 6:
+            schema.append(())
         else:
-            # column entry belongs to POS tagging of single words
-            pass
+            cells = tuple(cell for cell in wordColumns if cell[1] < length)
+            schema.append(cells)
 
-    return sent, nonSpeech, phones
+    return schema
 
 
-def populate_column_cat_count(columnDict, data):
+def populate_column_cat_count(columnDict, schema, line, segment):
     '''
     '''
-    segmStarts = [start for start, offset in SEGMENTS_OFFSETS]
+    # rows longer than the header provide all columns
+    cells = schema[min(len(line), len(schema) - 1)]
+
+    for column, position, split in cells:
+        # get word's category by looking in the cell belonging
+        # to the current column/spaCy annotation
+        category = line[position]
+        # correct entry for columns 'dep' and 'descr'
+        if split:
+            category = category.split(';')[0]
+        # increase count for the whole stimulus and the run/segment
+        columnDict[column].add(category, segment)
+
+    return columnDict
+
+
+def count_annotation(rows):
+    '''
+    fills the counters for sentences, non-speech, phonemes and the words'
+    columns in a single pass over the (streamed) rows of the annotation
+    '''
+    header = next(rows, None)
+
+    # initialize the counters
+    sent = CountStore()
+    nonSpeech = CountStore()
+    phones = CountStore()
+    columnDict = defaultdict(CountStore)
 
-    for line in data:
+    # boundaries of the segments and positions of the columns are
+    # computed once for all rows
+    segmIndex = SegmentIndex()
+    schema = compile_row_schema(header)
+
+    for line in rows:
         # check the run/segment we are in
-        run = get_run_number(segmStarts, line[0])
-        segment = str(run + 1)
-
-        # does the row contain a word?
-        if len(line) >= 6:
-            for column in header[2:-1]:
-                # NON-SPECH and X, XY (=other) have 6 not 11 columns
-                # so try for all columns in the header
+        segment = segmIndex.segment(line[0])
+
+        # sentences, non-speech und phonemes
+        populate_name_count(sent, nonSpeech, phones, line, segment)
+        # single words and their additional columns with linguistic features
+        populate_column_cat_count(columnDict, schema, line, segment)
+
+    return header, sent, nonSpeech, phones, columnDict
+
+
+def count_table(table):
+    '''
+    vectorized counterpart of count_annotation for the columnar (cached)
+    annotation
+    '''
+    header = table.header
+
+    # initialize the counters
+    sent = CountStore()
+    nonSpeech = CountStore()
+    phones = CountStore()
+    columnDict = defaultdict(CountStore)
+
+    segments = SegmentIndex().segments(table.onset)
+
+    def rows_flagged(flag):
+        # rows without a cell in the 'pos' column (code -1) are never flagged
+        posLabels = table.labels[header[4]].tolist()
+        isFlagged = [flag in label for label in posLabels] + [False]
+        return np.array(isFlagged)[table.codes[header[4]]]
+
+    # does the row contain a sentence, non-speech or a phoneme?
+    isSent = rows_flagged('SENTENCE')
+    isNonSpeech = rows_flagged('NONSPEECH') & ~isSent
+    isPhone = rows_flagged('PHONEME') & ~isSent & ~isNonSpeech
+    for counts, column, isRow in [(sent, header[2], isSent),
+                                  (nonSpeech, header[2], isNonSpeech),
+                                  (phones, header[3], isPhone)]:
+        counts.add_many(table.labels[column],
+                        table.codes[column][isRow],
+                        segments[isRow])
+
+    # single words and their additional columns with linguistic features
+    schema = compile_row_schema(header)
+    isWord = np.asarray(table.length) >= 6
+    for column, position, split in schema[-1]:
+        labels = table.labels[column].tolist()
+        codes = np.asarray(table.codes[column])
+        # correct entries for columns 'dep' and 'descr'
+        if split:
+            splitCodes = {}
+            remap = [splitCodes.setdefault(label.split(';')[0],
+                                           len(splitCodes))
+                     for label in labels]
+            codes = np.array(remap + [-1])[codes]
+            labels = list(splitCodes.keys())
+
+        # rows shorter than the header have no cell (code -1) in the column
+        isCounted = isWord & (codes >= 0)
+        columnDict[column].add_many(labels,
+                                    codes[isCounted],
+                                    segments[isCounted])
+
+    return header, sent, nonSpeech, phones, columnDict
+
+
+def row_digests(lines):
+    '''
+    64 bit digests of the (raw) lines of the annotation
+    '''
+    return np.frombuffer(b''.join(hashlib.blake2b(line, digest_size=8).digest()
+                                  for line in lines), dtype='<u8')
+
+
+def sorted_isin(values, sortedValues):
+    '''
+    np.isin for values that are to be looked up in a sorted array
+    '''
+    if len(sortedValues) == 0:
+        return np.zeros(len(values), dtype=bool)
+    positions = np.minimum(np.searchsorted(sortedValues, values),
+                           len(sortedValues) - 1)
+
+    return sortedValues[positions] == values
+
+
+def load_state(stateDir, header):
+    '''
+    returns the meta data, the distinct rows (sorted digests, their
+    multiplicities and their table) and the counts of the last run; None if
+    there is no usable state for this header
+    '''
+    meta = read_meta(stateDir)
+    if meta is None or meta['header'] != header:
+        return None
+
+    try:
+        with open(os.path.join(stateDir, 'counts.pickle'), 'rb') as f:
+            counts = pickle.load(f)
+        digests = np.load(os.path.join(stateDir, 'digests.npy'))
+        multiplicities = np.load(os.path.join(stateDir, 'multiplicities.npy'))
+    except (OSError, ValueError, pickle.UnpicklingError, EOFError):
+        return None
+
+    return meta, digests, multiplicities, \
+        load_cached_table(stateDir, meta), counts
+
+
+def count_incremental(inFile):
+    '''
+    updates the counts of the last run with the rows that were added or
+    removed since then (a changed row is removed and added)
+
+    the state (<inFile>.state) holds the counts and the distinct rows of the
+    annotation: their sorted digests, their multiplicities and their
+    categories (as AnnotationTable); only the lines whose digest is new are
+    parsed, and the state is not rewritten if the file did not change
+    '''
+    stateDir = inFile + '.state'
+    if os.path.isfile(stateDir):
+        # state of an older version (a pickle)
+        os.remove(stateDir)
+
+    stat = os.stat(inFile)
+    fileInfo = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+    meta = read_meta(stateDir)
+
+    content = None
+    if meta is None or meta['size'] != fileInfo['size'] or \
+            meta['mtime'] != fileInfo['mtime']:
+        with open(inFile, 'rb') as f:
+            content = f.read()
+        sha1 = hashlib.sha1(content).hexdigest()
+
+    # the file did not change (or was only touched): the counts of the
+    # last run are still valid, and only the time in the meta data is
+    # updated
+    if meta is not None and (content is None or meta['sha1'] == sha1):
+        state = load_state(stateDir, meta['header'])
+        if state is not None:
+            if content is not None:
+                meta.update(fileInfo)
                 try:
-                    # get word's category by looking in the cell belonging
-                    # to the current column/spaCy annotation
-                    category = line[header.index(column)]
-                    # correct entry for columns 'dep' and 'descr'
-                    if column in ['dep', 'descr']:
-                        category = category.split(';')[0]
-                    # increase count for the whole stimulus
-                    columnDict[column][category]['0'] += 1
-                    # increase count for the run/segment
-                    columnDict[column][category][segment] += 1
-                except:
+                    with open(os.path.join(stateDir, 'meta.json'), 'w') as f:
+                        json.dump(meta, f)
+                except OSError:
                     pass
+            return state[-1]
+
+    if content is None:
+        with open(inFile, 'rb') as f:
+            content = f.read()
+        sha1 = hashlib.sha1(content).hexdigest()
+
+    lines = content.split(b'\n')
+    if lines[-1] == b'':
+        lines.pop()
+    header = next(csv.reader([lines[0].decode()], delimiter='\t'))
+    lines = lines[1:]
+
+    state = load_state(stateDir, header)
+    if state is None:
+        # no usable state, so every row is a new one
+        oldDigests = np.zeros(0, dtype='<u8')
+        oldMultiplicities = np.zeros(0, dtype=np.int64)
+        oldTable = build_table(iter([header]))
+        oldCounts = None
+    else:
+        meta, oldDigests, oldMultiplicities, oldTable, oldCounts = state
+
+    # diff the multisets of rows
+    digests, firstLines, multiplicities = np.unique(
+        row_digests(lines), return_index=True, return_counts=True)
+    isOld = sorted_isin(digests, oldDigests)
+    oldRows = np.searchsorted(oldDigests, digests[isOld])
+    isKept = sorted_isin(oldDigests, digests)
+    keptRows = np.searchsorted(digests, oldDigests[isKept])
+
+    oldForNew = np.zeros(len(digests), dtype=np.int64)
+    oldForNew[isOld] = oldMultiplicities[oldRows]
+    newForOld = np.zeros(len(oldDigests), dtype=np.int64)
+    newForOld[isKept] = multiplicities[keptRows]
+    addedMultiplicities = np.maximum(multiplicities - oldForNew, 0)
+    removedMultiplicities = np.maximum(oldMultiplicities - newForOld, 0)
+
+    # the distinct rows: known ones from the state, only new ones are parsed
+    newRows = np.flatnonzero(~isOld)
+    parsed = build_table(chain([header], csv.reader(
+        [lines[line].decode() for line in firstLines[newRows].tolist()],
+        delimiter='\t')))
+    table = concat_tables(take_rows(oldTable, oldRows), parsed)
+    table = take_rows(table, np.argsort(np.concatenate(
+        [np.flatnonzero(isOld), newRows]), kind='stable'))
+
+    added = count_table(take_rows(
+        table, np.repeat(np.arange(len(digests)), addedMultiplicities)))
+    if oldCounts is None:
+        counts = added
+    else:
+        removed = count_table(take_rows(
+            oldTable, np.repeat(np.arange(len(oldDigests)),
+                                removedMultiplicities)))
+        counts = merge_counts([oldCounts, added])
+        for current, deleted in zip(counts[1:4], removed[1:4]):
+            current.subtract(deleted).prune()
+        for column, deleted in removed[4].items():
+            counts[4][column].subtract(deleted).prune()
+
+    meta = dict(fileInfo, sha1=sha1)
+    try:
+        save_table(table, stateDir, meta,
+                   {'digests.npy': digests,
+                    'multiplicities.npy': multiplicities,
+                    'counts.pickle': pickle.dumps(
+                        counts, protocol=pickle.HIGHEST_PROTOCOL)})
+    except OSError:
+        # e.g. the directory of the annotation is read-only
+        pass
+
+    return counts
+
+
+def count_file(inFile, useCache=True, incremental=False):
+    '''
+    counts one annotation file (used by the workers of the process pool)
+    '''
+    if incremental:
+        if inFile.lower().endswith('.textgrid'):
+            raise ValueError('incremental mode needs a .tsv: %s' % inFile)
+        return count_incremental(inFile)
 
-    return columnDict
+    if useCache:
+        # load the columnar annotation from the binary cache (it is created
+        # or updated if the .tsv changed) and count vectorized
+        return count_table(load_table(inFile))
 
+    # stream the annotation and populate the counters in a single pass
+    return count_annotation(stream_annotation(inFile))
 
-def print_speaker_per_run(statsFor, countsDict, topNr):
+
+def merge_counts(countsList):
+    '''
+    combines the counts of several annotation files (in the given order)
+    '''
+    header = countsList[0][0]
+    sent = CountStore()
+    nonSpeech = CountStore()
+    phones = CountStore()
+    columnDict = defaultdict(CountStore)
+
+    for counts in countsList:
+        sent.merge(counts[1])
+        nonSpeech.merge(counts[2])
+        phones.merge(counts[3])
+        for column, columnCounts in counts[4].items():
+            columnDict[column].merge(columnCounts)
+
+    return header, sent, nonSpeech, phones, columnDict
+
+
+def print_speaker_per_run(statsFor, counts, topNr):
     '''
     '''
     # print the total number of sentences (or non-speech or phonemes)
-    nrOfSents = sum([countsDict[x]['0'] for x in countsDict.keys()])
-    print(statsFor + '\t', nrOfSents)
-
-    # sentences per speaker
-    # get a list of all speakers
-    speakers = [[speaker] for speaker in countsDict.keys()]
-    # add the counts for the whole stimulus [str('0')]
-    # and the individual runs [indices 1-8])
-    for speaker in speakers:
-        allRuns = [countsDict[speaker[0]][str(x)] for x in range(0, 9)]
-        speaker.extend(allRuns)
-    # sort the list from speaker with most spoken sentences to
-    # speaker with least spoken sentences
-    speakers = sorted(speakers, key=lambda x: -x[1])
+    print(statsFor + '\t', counts.total())
+
+    # sentences per speaker for the whole stimulus and the individual runs
+    # sorted from speaker with most spoken sentences to speaker with least
+    # spoken sentences
+    speakers = counts.rows(counts.ranked())
 
     # PRINTING FOR SENTENCES
     for speaker in speakers[:topNr]:
@@ -167,42 +461,28 @@ def print_speaker_per_run(statsFor, countsDict, topNr):
     return None
 
 
-def print_word_columns(countsWor, topNr):
+def print_word_columns(header, countsWor, topNr):
     '''
     '''
     # count & print the total number of words
-    nrOfWords = sum([countsWor['text'][x]['0'] for x in countsWor['text'].keys()])
-    print('\nWords', '\t', nrOfWords)
+    print('\nWords', '\t', countsWor['text'].total())
 
     # overview of words' additional columns
     for column in header:
         # filter for the relevant coulmns
         if column not in ['person', 'pos', 'tag', 'dep', 'descr']:
             continue
-        else:
-            # for the current column/annotation, make a list of all
-            # occuring categories by looking up the keys that exist in the dict
-            # add the counts per segment later by extending a category's item
-                categories = [[category] for category
-                              in countsWor[column].keys()
-                              if category not in ['', '##']]
-
-        # create the list with the counts per segment
-        # that will be added
-        for category in categories:
-            # add explanation of categories of 'pos', 'tag', and 'dep'
-            if column in ['pos', 'tag', 'dep']:
-                allRuns = [countsWor[column][category[0]][str(x)]
-                           for x in range(0, 9)]
-                allRuns.append(spacy.explain(category[0]))
-            else:
-                allRuns = [countsWor[column][category[0]][str(x)]
-                           for x in range(0, 9)]
-
-            # add the information of all runs
-            category.extend(allRuns)
-
-        categories = sorted(categories, key=lambda x: -x[1])
+
+        # for the current column/annotation, make a list of all
+        # occuring categories with their counts per segment
+        # sorted from most to least often occurring category
+        counts = countsWor[column]
+        categories = counts.rows(counts.ranked(exclude=['', '##']))
+
+        # add explanation of categories of 'pos', 'tag', and 'dep'
+        if column in ['pos', 'tag', 'dep']:
+            for category in categories:
+                category.append(explain(category[0]))
 
         # PRINTING FOR WORDS
         print(column)
@@ -214,15 +494,10 @@ def print_word_columns(countsWor, topNr):
     return None
 
 
-def statsSentPhones(statsFor, countsDict):
+def statsSentPhones(statsFor, counts):
     '''
     '''
-    countsPerRun = defaultdict(int)
-    for speaker in list(countsDict.keys()):
-        for run in countsDict[speaker].keys():
-            countsPerRun[run] += countsDict[speaker][run]
-
-    perRun = [countsPerRun[run] for run in sorted(countsPerRun.keys())]
+    perRun = counts.per_run().tolist()
 
     line = [str(x) for x in perRun]
     line = statsFor + '\t' + '\t'.join(line)
@@ -241,44 +516,17 @@ def statsSentPhones(statsFor, countsDict):
 def statsWords(countsWor):
     '''
     '''
-    statsFor = 'Words'
-
-    countsPerRun = defaultdict(int)
-    for speaker in list(countsWor['person'].keys()):
-
-        for run in countsWor['person'][speaker].keys():
-            countsPerRun[run] += countsWor['person'][speaker][run]
-
-    perRun = [countsPerRun[run] for run in sorted(countsPerRun.keys())]
-
-    line = [str(x) for x in perRun]
-    line = 'Words\t' + '\t'.join(line)
-    print(line)
-
-    labels = ['a%s%s' % (statsFor, no2alpha[x]) for x in range(0, 9)]
-    labelsAndCounts = list(zip(labels, perRun))
-    linesForLatex = ['\\newcommand{\\%s}{%s}\n' % (label, count)
-                     for label, count in labelsAndCounts]
-
-    linesForLatex.append('\n')
-
-    return(linesForLatex)
+    # every word has a speaker, so the words per run are the sum
+    # over the speakers
+    return statsSentPhones('Words', countsWor['person'])
 
 
-def sentsBySpeaker(countSen, topNr):
+def sentsBySpeaker(countsSen, topNr):
     '''
     '''
-    # get a list of all speakers
-    speakers = [[speaker] for speaker in countsSen.keys()]
-    # add the counts for the whole stimulus [str('0')]
-    # and the individual runs [indices 1-8])
-    for speaker in speakers:
-        allRuns = [countsSen[speaker[0]][str(x)] for x in range(0, 9)]
-        speaker.extend(allRuns)
-    # sort the list from speaker with most spoken sentences to
-    # speaker with least spoken sentences
-    # sort by count, most first
-    speakers = sorted(speakers, key=lambda x: -x[1])
+    # list of all speakers with the counts for the whole stimulus
+    # and the individual runs, sorted by count, most first
+    speakers = countsSen.rows(countsSen.ranked())
     # sort top x alphabetically
     speakers = sorted(speakers[:topNr])
 
@@ -303,26 +551,20 @@ def sentsBySpeaker(countSen, topNr):
     return linesForLatex
 
 
-def statsWordsColumns(colName, currentColumnDict, topNr):
+def statsWordsColumns(colName, counts, topNr):
     '''
     '''
-    categories = [[category] for category in currentColumnDict.keys()
-                  if category not in ['', '###']]
-
-    for category in categories:
-        # add explanation of categories of 'pos', 'tag', and 'dep'
-        allRuns = [currentColumnDict[category[0]][str(x)]
-                   for x in range(0, 9)]
-        allRuns.append(spacy.explain(category[0]))
-
-        # add the information of all runs
-        category.extend(allRuns)
-
     # sort by count, most first
-    categories = sorted(categories, key=lambda x: -x[1])
+    categories = counts.rows(counts.ranked(exclude=['', '###']))
     # sort by top x by alphabetically
     categories = sorted(categories[:topNr])
 
+    # add explanation of categories of 'pos', 'tag', and 'dep'; descriptive
+    # nouns are no spaCy labels, so do not fall back to loading spaCy for them
+    fallback = colName != 'Descr'
+    for category in categories:
+        category.append(explain(category[0], fallback))
+
     for x in categories[:topNr]:
         x = [str(index) for index in x]
         print('\t'.join(x))
@@ -352,7 +594,7 @@ def statsWordsColumns(colName, currentColumnDict, topNr):
     return linesForLatex
 
 
-def write_tex_file(outFile):
+def write_tex_file(outFile, countsSen, countsWor, countsPho):
     '''
     this is used to generate the .tex-file for the reproducible paper
     '''
@@ -420,26 +662,11 @@ def write_tex_file(outFile):
         f.writelines(toWrite)
 
 
-# main programm
-if __name__ == "__main__":
-    # read the BIDS .tsv
-    inFile, outFile = parse_arguments()
-
-    header, fContent = read_file(inFile)
-
-    # get data in shape to do the descriptive statistics
-    # initialize the dictionaries
-    countsSen = defaultdict(lambda: defaultdict(int))
-    countsNon = defaultdict(lambda: defaultdict(int))
-    countsPho = defaultdict(lambda: defaultdict(int))
-    countsWor = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
-
-    # loop through the annotation content and populate the dictionaries
-    # sentences, non-speech und phonemes
-    countsSen, countsNon, countsPho = populate_name_count(
-        countsSen, countsNon, countsPho, fContent)
-    # single words and their additional columns with linguistic features
-    countsWor = populate_column_cat_count(countsWor, fContent)
+def report(counts, outFile):
+    '''
+    prints the statistics or writes them to the .tex-file
+    '''
+    header, countsSen, countsNon, countsPho, countsWor = counts
 
     if outFile is None:
         # this was used for exploratory analyses of the
@@ -448,9 +675,67 @@ if __name__ == "__main__":
         # last argument ist the top count of categories to print
         print_speaker_per_run('Sentences:', countsSen, -1)
         print_speaker_per_run('Non-Speech:', countsNon, -1)
-        print_word_columns(countsWor, -1)
+        print_word_columns(header, countsWor, -1)
         # statistics for phonemes uses the same functions as stats for speakers
         print_speaker_per_run('Phonemes:', countsPho, -1)
 
     if outFile is not None:
-        write_tex_file(outFile)
+        write_tex_file(outFile, countsSen, countsWor, countsPho)
+
+
+def per_file_outs(outFile, inFiles):
+    '''
+    names of the .tex-files for the statistics of the single input files;
+    the input's path relative to the directory all inputs share is part of
+    the name (e.g. de/anno.tsv -> <out>-de-anno.tex)
+    '''
+    if outFile is None:
+        return [None] * len(inFiles)
+
+    stem, ext = os.path.splitext(outFile)
+    baseDir = os.path.commonpath([os.path.dirname(os.path.abspath(fpath))
+                                  for fpath in inFiles])
+
+    outFiles = []
+    for inFile in inFiles:
+        relPath = os.path.relpath(os.path.abspath(inFile), baseDir)
+        inName = os.path.splitext(relPath)[0].replace(os.sep, '-')
+        outFiles.append('%s-%s%s' % (stem, inName, ext))
+
+    # e.g. anno.tsv and anno.TextGrid in the same directory
+    for outFpath in set(outFiles):
+        collisions = [inFile for inFile, fpath in zip(inFiles, outFiles)
+                      if fpath == outFpath]
+        if len(collisions) > 1:
+            raise ValueError('%s would be written for each of %s' %
+                             (outFpath, ', '.join(collisions)))
+
+    return outFiles
+
+
+# main programm
+if __name__ == "__main__":
+    # read the BIDS .tsv
+    inPattern, outFile, useCache, nrOfWorkers, incremental = \
+        parse_arguments()
+    inFiles = find_input_files(inPattern)
+    perFileOuts = per_file_outs(outFile, inFiles)
+
+    if len(inFiles) == 1:
+        report(count_file(inFiles[0], useCache, incremental), outFile)
+    else:
+        # count every file in its own process; the counters are merged in
+        # the order of the files afterwards
+        with ProcessPoolExecutor(max_workers=nrOfWorkers) as executor:
+            countsPerFile = list(executor.map(count_file,
+                                              inFiles,
+                                              repeat(useCache),
+                                              repeat(incremental)))
+
+        for inFile, counts, perFileOut in zip(inFiles, countsPerFile,
+                                              perFileOuts):
+            print('\n# %s' % inFile)
+            report(counts, perFileOut)
+
+        print('\n# combined')
+        report(merge_counts(countsPerFile), outFile)
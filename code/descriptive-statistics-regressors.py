@@ -3,9 +3,14 @@
 created on Fri March 27 2020
 author: Christian Olaf Haeusler
 '''
-from glob import glob
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import argparse
-import os.path
+import numpy as np
+import os
+import re
+from regressors import REGISTRY_FILE, load_registry
+from segments import SEGMENTS_OFFSETS
 
 
 def parse_arguments():
@@ -22,12 +27,30 @@ def parse_arguments():
                         default=None,
                         help='the output file. e.g. ./descr-stats-regressors.tex')
 
+    parser.add_argument('-j',
+                        type=int,
+                        default=16,
+                        help='number of threads reading the event files')
+
+    parser.add_argument('-r',
+                        default=REGISTRY_FILE,
+                        help='the table of regressors; registered regressors '
+                        'are written in its order, others after them')
+
+    parser.add_argument('-x', '--extended',
+                        action='store_true',
+                        help='also write duration, inter-event interval and '
+                        'coverage statistics of every regressor')
+
     args = parser.parse_args()
 
     inDir = args.d
     outFile = args.o
+    nrOfThreads = args.j
+    extended = args.extended
+    registryFile = args.r
 
-    return inDir, outFile
+    return inDir, outFile, nrOfThreads, extended, registryFile
 
 no2alpha = {0: 'All',
             1: 'I',
@@ -40,41 +63,293 @@ no2alpha = {0: 'All',
             8: 'VIII'
             }
 
-if __name__ == "__main__":
-    inDir, outFile = parse_arguments()
+# length of the runs (= stimulus segments) in seconds
+RUN_LENGTHS = [SEGMENTS_OFFSETS[run + 1][0] - SEGMENTS_OFFSETS[run][0]
+               for run in range(0, len(SEGMENTS_OFFSETS) - 1)]
+
+
+def index_event_files(inDir):
+    '''
+    walks the directory once and returns a dict that maps every regressor
+    to a dict of its runs (= directory relative to inDir, e.g. run-1 or
+    sub-01/run-1) and event files
+    '''
+    index = defaultdict(dict)
+    for root, dirs, files in os.walk(inDir, followlinks=True):
+        # ignore hidden directories and files (as glob does)
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for fName in files:
+            regressor, ext = os.path.splitext(fName)
+            if ext != '.txt' or fName.startswith('.'):
+                continue
+            run = os.path.relpath(root, inDir)
+            index[regressor][run] = os.path.join(root, fName)
+
+    # sort the runs of every regressor by path of their event file
+    index = {regressor: dict(sorted(runs.items(), key=lambda x: x[1]))
+             for regressor, runs in sorted(index.items())}
+
+    return index
+
+
+def run_number(run):
+    '''
+    number of a run from the name of its directory (e.g. run-3 -> 3); None
+    if the name does not contain one
+    '''
+    match = re.search(r'run-(\d+)', os.path.basename(run))
+
+    return int(match.group(1)) if match else None
+
+
+def run_name(run):
+    '''
+    the name of a run (its number, or its directory if it has none) in the
+    macros; None if it cannot be named
+    '''
+    return no2alpha.get(run) if isinstance(run, int) and run > 0 else None
+
+
+def group_runs(runs):
+    '''
+    groups the event files of a regressor by the number of their run, so
+    that the runs of several subjects (e.g. sub-01/run-1, sub-02/run-1) are
+    pooled; runs without a number are grouped by their directory; returns
+    a dict of the runs (numbers first) and lists of event files
+    '''
+    groups = defaultdict(list)
+    for run, fpath in runs.items():
+        number = run_number(run)
+        groups[run if number is None else number].append(fpath)
+
+    return dict(sorted(groups.items(),
+                       key=lambda x: (0, x[0], '') if isinstance(x[0], int)
+                       else (1, 0, x[0])))
+
+
+def registry_order(index, registry):
+    '''
+    sorts the regressors of the index by their position in the registry;
+    regressors that are not registered follow in alphabetical order
+    '''
+    def position(regressor):
+        pos = registry.by_event_file(regressor)
+        return (0, pos, '') if pos is not None else (1, 0, regressor)
+
+    return {regressor: index[regressor]
+            for regressor in sorted(index, key=position)}
+
+
+def count_lines(fpath, blockSize=2 ** 20):
+    '''
+    counts the lines (= events) of a file by counting newlines blockwise
+    '''
+    nrOfLines = 0
+    lastChar = b'\n'
+    with open(fpath, 'rb') as f:
+        for block in iter(lambda: f.read(blockSize), b''):
+            nrOfLines += block.count(b'\n')
+            lastChar = block[-1:]
+
+    # the last line might not end with a newline
+    if lastChar != b'\n':
+        nrOfLines += 1
+
+    return nrOfLines
+
+
+def read_bytes(fpath):
+    '''
+    '''
+    with open(fpath, 'rb') as f:
+        return f.read()
+
+
+def load_ev3_files(fPathes, nrOfThreads=16):
+    '''
+    parses the onset, duration and amplitude columns of all EV3 files at
+    once; returns one array of shape events x 3 and the boundaries of the
+    files in it (events of file i are events[bounds[i]:bounds[i + 1]])
+    '''
+    with ThreadPoolExecutor(max_workers=nrOfThreads) as executor:
+        contents = list(executor.map(read_bytes, fPathes))
+
+    # tokens per file give the boundaries between the files
+    tokens = [content.split() for content in contents]
+    nrOfTokens = np.array([len(fileTokens) for fileTokens in tokens])
+    if np.any(nrOfTokens % 3):
+        raise ValueError('EV3 files must have three columns')
+
+    events = np.array([token for fileTokens in tokens for token in fileTokens],
+                      dtype=np.float64).reshape(-1, 3)
+    bounds = np.concatenate([[0], np.cumsum(nrOfTokens // 3)])
+
+    return events, bounds
+
+
+def covered_time(onsets, durations):
+    '''
+    length of the union of the intervals [onset, onset + duration]
+    '''
+    if len(onsets) == 0:
+        return 0.0
+
+    order = np.argsort(onsets, kind='stable')
+    starts = onsets[order]
+    ends = starts + durations[order]
+    # an interval starts a new block of overlapping intervals if it starts
+    # after all previous intervals ended
+    maxEnds = np.maximum.accumulate(ends)
+    newBlock = np.concatenate([[True], starts[1:] > maxEnds[:-1]])
+    blockStarts = np.flatnonzero(newBlock)
+    covered = maxEnds[np.append(blockStarts[1:] - 1, len(ends) - 1)] \
+        - starts[blockStarts]
+
+    return float(covered.sum())
+
+
+def summarize(func, arrays):
+    '''
+    applies func to all values (whole stimulus) and to the values of every
+    run; empty runs get 0
+    '''
+    allValues = np.concatenate(arrays) if arrays else np.zeros(0)
+
+    return [float(func(values)) if len(values) else 0.0
+            for values in [allValues] + arrays]
 
-    # search for event files in the given directory
-    pattern = os.path.join(inDir, '**/*.txt')
-    fPathes = sorted(glob(pattern, recursive=True))
 
-    # get a list of regressors from the event files
-    fileNames = [os.path.basename(path) for path in fPathes]
-    regressors = [os.path.splitext(fileName)[0] for fileName in fileNames]
-    regressors = sorted(list(set(regressors)))
+def event_statistics(runEvents, runNumbers, runLengths):
+    '''
+    statistics of the events of a regressor for the whole stimulus (first
+    entry of every list) and every run; runEvents is a list (runs with the
+    given numbers) of lists (e.g. subjects) of events x 3 arrays (onset,
+    duration, amplitude)
+    '''
+    durations = [np.concatenate([events[:, 1] for events in files])
+                 for files in runEvents]
+    # inter-event intervals are computed within an event file only
+    intervals = [np.concatenate([np.diff(np.sort(events[:, 0]))
+                                 for events in files])
+                 for files in runEvents]
+
+    statistics = {
+        'Duration': summarize(np.sum, durations),
+        'MeanDuration': summarize(np.mean, durations),
+        'MedianDuration': summarize(np.median, durations),
+        'MeanIei': summarize(np.mean, intervals),
+        'MedianIei': summarize(np.median, intervals),
+        'MinIei': summarize(np.min, intervals)
+    }
+
+    # fraction (in percent) of the runs covered by events (of all files of
+    # a run); runs without a known length get NaN and are left out of the
+    # whole stimulus' value
+    lengths = np.array([len(files) * runLengths[number - 1]
+                        if isinstance(number, int) and
+                        1 <= number <= len(runLengths) else np.nan
+                        for files, number in zip(runEvents, runNumbers)])
+    covered = np.array([sum(covered_time(events[:, 0], events[:, 1])
+                            for events in files)
+                        for files in runEvents])
+    known = ~np.isnan(lengths)
+    allCoverage = 100 * covered[known].sum() / lengths[known].sum() \
+        if known.any() else np.nan
+    statistics['Coverage'] = [allCoverage] + (100 * covered / lengths).tolist()
+
+    return statistics
 
+
+def extended_lines(regressor, statistics, runNumbers):
+    '''
+    macros of the statistics of the whole stimulus and of every run (named
+    after its number); undefined values (NaN) and runs without a name are
+    left out
+    '''
+    names = [no2alpha[0]] + [run_name(number) for number in runNumbers]
     toWrite = []
-    for regressor in regressors:
-        # filter list of all event files for the current loop's regressor
-        pattern = '/%s.txt' % regressor
-        regFiles = [ev3File for ev3File in fPathes if pattern in ev3File]
+    for statName, values in statistics.items():
+        for name, value in zip(names, values):
+            if name is None or np.isnan(value):
+                continue
+            line = '\\newcommand{\\r%s%s%s}{%.2f}\n' % (
+                regressor.capitalize(), statName, name, value)
+            toWrite.append(line)
+        toWrite.append('\n')
+
+    return toWrite
 
-        # count the lines (=events) per file/run
-        eventsPerRun = []
-        for regFile in regFiles:
-            noOfEvents = sum(1 for eventsPerRun in open(regFile))
-            eventsPerRun.append(noOfEvents)
+
+if __name__ == "__main__":
+    inDir, outFile, nrOfThreads, extended, registryFile = parse_arguments()
+
+    # search for event files in the given directory & get the regressors
+    # and their runs from the event files
+    index = registry_order(index_event_files(inDir),
+                           load_registry(registryFile))
+
+    # count the lines (=events) of all files; reading the files is I/O-bound,
+    # so do it in threads
+    fPathes = [fpath for runs in index.values() for fpath in runs.values()]
+    with ThreadPoolExecutor(max_workers=nrOfThreads) as executor:
+        linesPerFile = dict(zip(fPathes, executor.map(count_lines, fPathes)))
+
+    # the files of a regressor are grouped by the number in the name of
+    # their run's directory (a regressor might not have a file for every
+    # run); the runs of several subjects are pooled, and the number names
+    # the macros and gives the length of the run
+    groups = {regressor: group_runs(runs) for regressor, runs in index.items()}
+    nrOfFiles = defaultdict(set)
+    for regressor, runGroups in groups.items():
+        for run, regFiles in runGroups.items():
+            nrOfFiles[run].add(len(regFiles))
+    for run in sorted(nrOfFiles, key=str):
+        if run_name(run) is None:
+            print('warning: run %s is not one of the runs 1-%i; no macros '
+                  'are written for it' % (run, max(no2alpha)))
+        if extended and not (isinstance(run, int) and
+                             1 <= run <= len(RUN_LENGTHS)):
+            print('warning: the length of run %s is unknown; it is left out '
+                  'of the coverage' % run)
+    maxFiles = max([max(sizes) for sizes in nrOfFiles.values()] + [0])
+    if maxFiles > 1:
+        print('pooling the event files of up to %i directories (e.g. '
+              'subjects) per run' % maxFiles)
+
+    if extended:
+        # parse all event files of all regressors at once
+        events, bounds = load_ev3_files(fPathes, nrOfThreads)
+        eventsPerFile = {fpath: events[bounds[i]:bounds[i + 1]]
+                         for i, fpath in enumerate(fPathes)}
+
+    toWrite = []
+    for regressor, runGroups in groups.items():
+        # the counts of the current loop's regressor per run (summed over
+        # the files of a run)
+        eventsPerRun = [sum(linesPerFile[regFile] for regFile in regFiles)
+                        for regFiles in runGroups.values()]
+        names = [run_name(run) for run in runGroups]
 
         # put the count for all events at the beginning of the list
         eventsPerRun.insert(0, sum(eventsPerRun))
+        names.insert(0, no2alpha[0])
 
         # build the lines for the current regressor to write to file
-        for run, count in enumerate(eventsPerRun):
-            regressor = regressor.capitalize()
-            run = no2alpha[run]
-            line = '\\newcommand{\\r%s%s}{%s}\n' % (regressor, run, count)
+        regressor = regressor.capitalize()
+        for name, count in zip(names, eventsPerRun):
+            if name is None:
+                continue
+            line = '\\newcommand{\\r%s%s}{%s}\n' % (regressor, name, count)
             toWrite.append(line)
-            if run == 'VIII':
-                toWrite.append('\n')
+        toWrite.append('\n')
+
+        if extended:
+            statistics = event_statistics(
+                [[eventsPerFile[regFile] for regFile in regFiles]
+                 for regFiles in runGroups.values()],
+                list(runGroups), RUN_LENGTHS)
+            toWrite.extend(extended_lines(regressor, statistics,
+                                          list(runGroups)))
 
     # write the file if a filename was passed as command line argument
     toWrite = [line.replace('_', '') for line in toWrite]
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+'''
+counts the voxels of the three thresholded z-maps of the figure (words >
+no-speech, ne > kon, nn > kon), their pairwise overlap, their clusters and
+the fraction inside the field of view, and writes the numbers as LaTeX
+macros
+'''
+from scipy import ndimage
+import argparse
+import nibabel as nib
+import numpy as np
+import os
+from glm import COPE_DIR, threshold_name
+
+
+# thresholded z-map of a cope (number) at a z threshold
+COPE_PATTERN = os.path.join(COPE_DIR, 'cope1.feat', 'thresh_zstat1.nii.gz')
+
+# primary contrasts of the figure and the names used in the macros
+MAPS = [(1, 'Words'), (3, 'Ne'), (5, 'Nn')]
+
+no2alpha = {1: 'I',
+            2: 'II',
+            3: 'III',
+            4: 'IV',
+            5: 'V',
+            6: 'VI',
+            7: 'VII',
+            8: 'VIII',
+            9: 'IX',
+            10: 'X'
+            }
+
+
+def parse_arguments():
+    '''
+    '''
+    parser = argparse.ArgumentParser(
+        description='computes overlap & cluster statistics of the z-maps'
+    )
+    parser.add_argument('-d',
+                        default='inputs/studyforrest-speechanno-validation/3rd-lvl',
+                        help='directory that contains 3rd lvl COPE directories')
+
+    parser.add_argument('-m',
+                        default='code/fov_tmpl_0.5.nii.gz',
+                        help='the field of view (voxels > 0)')
+
+    parser.add_argument('-t',
+                        default='3.4',
+                        help='z threshold (as in the COPE directory names)')
+
+    parser.add_argument('-c',
+                        type=int,
+                        default=5,
+                        help='number of largest clusters per map to report')
+
+    parser.add_argument('-o',
+                        default=None,
+                        help='the output file. e.g. ./descr-stats-zmaps.tex')
+
+    args = parser.parse_args()
+
+    inDir = args.d
+    fovFile = args.m
+    threshold = args.t
+    nrOfClusters = min(args.c, len(no2alpha))
+    outFile = args.o
+
+    return inDir, fovFile, threshold, nrOfClusters, outFile
+
+
+def load_maps(fpathes):
+    '''
+    loads the z-maps into one array (maps x voxels); all maps must share
+    one grid
+    '''
+    imgs = [nib.load(fpath) for fpath in fpathes]
+    for img, fpath in zip(imgs[1:], fpathes[1:]):
+        if img.shape != imgs[0].shape or \
+                not np.allclose(img.affine, imgs[0].affine):
+            raise ValueError('%s is not on the grid of %s' %
+                             (fpath, fpathes[0]))
+
+    zMaps = np.stack([np.asarray(img.dataobj, dtype=np.float32)
+                      for img in imgs])
+
+    return zMaps, imgs[0].affine
+
+
+def overlaps(masks):
+    '''
+    Dice and Jaccard coefficients of all pairs of masks (maps x voxels)
+    '''
+    flat = masks.reshape(len(masks), -1)
+    intersections = np.array([[np.count_nonzero(flat[i] & flat[j])
+                               for j in range(len(flat))]
+                              for i in range(len(flat))])
+    sizes = np.diag(intersections)
+    sums = sizes[:, np.newaxis] + sizes[np.newaxis, :]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dice = 2 * intersections / sums
+        jaccard = intersections / (sums - intersections)
+
+    return intersections, np.nan_to_num(dice), \
+        np.nan_to_num(jaccard)
+
+
+def clusters(zMap, mask, affine):
+    '''
+    connected components (26-neighbourhood as in FSL's cluster) of a mask,
+    largest first; returns their sizes, peak z values and the world
+    coordinates of the peaks
+    '''
+    labels, nrOfLabels = ndimage.label(mask, structure=np.ones((3, 3, 3)))
+    if nrOfLabels == 0:
+        return np.zeros(0, dtype=int), np.zeros(0), np.zeros((0, 3))
+
+    # only the voxels inside clusters are sorted (by cluster, then by
+    # descending z), so the first voxel of every cluster is its peak
+    voxels = np.flatnonzero(labels)
+    voxelLabels = labels.ravel()[voxels]
+    values = zMap.ravel()[voxels]
+    order = np.lexsort((-values, voxelLabels))
+    first = order[np.searchsorted(voxelLabels[order],
+                                  np.arange(1, nrOfLabels + 1))]
+
+    sizes = np.bincount(voxelLabels, minlength=nrOfLabels + 1)[1:]
+    peaks = values[first]
+    positions = np.column_stack(np.unravel_index(voxels[first], zMap.shape))
+    coords = nib.affines.apply_affine(affine, positions)
+
+    order = np.lexsort((-peaks, -sizes))
+
+    return sizes[order], peaks[order], coords[order]
+
+
+def fov_fractions(masks, affine, fovFile):
+    '''
+    fraction of every mask's voxels whose center lies inside the field of
+    view (nearest voxel of the field of view's grid)
+    '''
+    fovImg = nib.load(fovFile)
+    fov = np.asarray(fovImg.dataobj) > 0
+
+    fractions = []
+    for mask in masks:
+        voxels = np.argwhere(mask)
+        if len(voxels) == 0:
+            fractions.append(0.0)
+            continue
+        # map the voxels' centers into the grid of the field of view
+        fovVoxels = np.rint(nib.affines.apply_affine(
+            np.linalg.inv(fovImg.affine) @ affine, voxels)).astype(int)
+        inGrid = np.all((fovVoxels >= 0) & (fovVoxels < fov.shape), axis=1)
+        inside = np.zeros(len(voxels), dtype=bool)
+        inside[inGrid] = fov[tuple(fovVoxels[inGrid].T)]
+        fractions.append(inside.mean())
+
+    return np.array(fractions)
+
+
+def macro(name, value):
+    '''
+    '''
+    return '\\newcommand{\\z%s}{%s}\n' % (name, value)
+
+
+if __name__ == "__main__":
+    inDir, fovFile, threshold, nrOfClusters, outFile = parse_arguments()
+
+    # load the maps once
+    fpathes = [os.path.join(inDir, COPE_PATTERN %
+                            (cope, threshold_name(threshold)))
+               for cope, name in MAPS]
+    zMaps, affine = load_maps(fpathes)
+    masks = zMaps > float(threshold)
+    voxelVolume = abs(np.linalg.det(affine[:3, :3]))
+
+    names = [name for cope, name in MAPS]
+    intersections, dice, jaccard = overlaps(masks)
+    if os.path.exists(fovFile):
+        fractions = fov_fractions(masks, affine, fovFile)
+    else:
+        print('field of view %s not found' % fovFile)
+        fractions = None
+
+    toWrite = []
+    for i, name in enumerate(names):
+        toWrite.append(macro(name + 'Voxels', intersections[i, i]))
+        toWrite.append(macro(name + 'Volume', '%i' % round(
+            intersections[i, i] * voxelVolume)))
+        if fractions is not None:
+            toWrite.append(macro(name + 'InFov', '%.1f' % (100 * fractions[i])))
+        toWrite.append('\n')
+
+    for i in range(len(names)):
+        for j in range(i + 1, len(names)):
+            pair = names[i] + names[j]
+            toWrite.append(macro(pair + 'Voxels', intersections[i, j]))
+            toWrite.append(macro(pair + 'Dice', '%.2f' % dice[i, j]))
+            toWrite.append(macro(pair + 'Jaccard', '%.2f' % jaccard[i, j]))
+            toWrite.append('\n')
+
+    for i, name in enumerate(names):
+        sizes, peaks, coords = clusters(zMaps[i], masks[i], affine)
+        toWrite.append(macro(name + 'Clusters', len(sizes)))
+        for nr, (size, peak, coord) in enumerate(
+                zip(sizes[:nrOfClusters], peaks, coords), start=1):
+            cluster = name + 'Cluster' + no2alpha[nr]
+            toWrite.append(macro(cluster + 'Voxels', size))
+            toWrite.append(macro(cluster + 'Peak', '%.2f' % peak))
+            for axis, value in zip('XYZ', coord):
+                toWrite.append(macro(cluster + axis, '%i' % round(value)))
+            print('%s cluster %i: %i voxels, peak z=%.2f at (%i, %i, %i)' %
+                  ((name, nr, size, peak) + tuple(np.round(coord))))
+        toWrite.append('\n')
+
+    # write the file if a filename was passed as command line argument
+    if outFile is not None:
+        with open(outFile, 'w') as f:
+            f.writelines(toWrite)
+    else:
+        print(''.join(toWrite))
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+'''
+builds design matrices (regressors convolved with a double-gamma HRF plus
+their temporal derivatives) from EV3 files without running FSL FEAT
+
+the columns have the layout of FEAT's design.mat: regressor 1, its
+temporal derivative, regressor 2, its temporal derivative, ...
+'''
+from scipy import signal, stats
+import numpy as np
+import os
+from segments import SEGMENTS_OFFSETS
+
+
+# repetition time of the fMRI runs in seconds
+TR = 2.0
+# resolution of the boxcar functions before the convolution in seconds
+DT = 0.05
+# number of volumes of every run if not given: length of the segments
+NR_OF_VOLUMES = [int(np.ceil((SEGMENTS_OFFSETS[run + 1][0]
+                              - SEGMENTS_OFFSETS[run][0]) / TR))
+                 for run in range(0, len(SEGMENTS_OFFSETS) - 1)]
+
+
+def double_gamma_hrf(dt=DT, length=32.0):
+    '''
+    double-gamma HRF (peak at 6 s, undershoot at 16 s with a ratio of 1/6)
+    sampled every dt seconds; normalized to an area of 1
+    '''
+    times = np.arange(0, length, dt)
+    hrf = stats.gamma.pdf(times, 6) - stats.gamma.pdf(times, 16) / 6.0
+
+    return hrf / hrf.sum()
+
+
+def read_ev3(fpath):
+    '''
+    reads an EV3 file into an array of shape events x 3
+    '''
+    with open(fpath, 'rb') as f:
+        values = np.array(f.read().split(), dtype=np.float64)
+
+    return values.reshape(-1, 3)
+
+
+def parse_design_mat(content):
+    '''
+    parses the content (bytes) of a FEAT design.mat file into an array of
+    shape /NumPoints x /NumWaves
+    '''
+    header, sep, matrix = content.partition(b'/Matrix')
+    if not sep:
+        raise ValueError('design.mat has no /Matrix block')
+
+    sizes = {}
+    for line in header.splitlines():
+        fields = line.split()
+        if len(fields) == 2 and fields[0] in (b'/NumWaves', b'/NumPoints'):
+            sizes[fields[0]] = int(fields[1])
+
+    values = np.array(matrix.split(), dtype=np.float64)
+    nrOfWaves = sizes.get(b'/NumWaves')
+    nrOfPoints = sizes.get(b'/NumPoints', len(values) // (nrOfWaves or 1))
+    if nrOfWaves is None or len(values) != nrOfWaves * nrOfPoints:
+        raise ValueError('design.mat has %i values but /NumWaves %s and '
+                         '/NumPoints %s' % (len(values), nrOfWaves,
+                                            sizes.get(b'/NumPoints')))
+
+    return values.reshape(nrOfPoints, nrOfWaves)
+
+
+def read_design_mat(fpath, useCache=True, dtype=np.float64):
+    '''
+    reads a FEAT design.mat file (points x waves); the parsed matrix is
+    cached as <fpath>.npy, which is valid as long as it has the same mtime
+    as the design file
+    '''
+    cacheFile = fpath + '.npy'
+    mtime = os.stat(fpath).st_mtime_ns
+
+    if useCache and os.path.exists(cacheFile) and \
+            os.stat(cacheFile).st_mtime_ns == mtime:
+        return np.load(cacheFile).astype(dtype, copy=False)
+
+    with open(fpath, 'rb') as f:
+        design = parse_design_mat(f.read())
+
+    if useCache:
+        # write to a temporary file first, so that a concurrent reader
+        # never sees a partial cache
+        tmpFile = '%s.%i.tmp.npy' % (fpath, os.getpid())
+        try:
+            np.save(tmpFile, design)
+            os.utime(tmpFile, ns=(mtime, mtime))
+            os.replace(tmpFile, cacheFile)
+        except OSError:
+            # e.g. a read-only dataset; just do not cache
+            if os.path.exists(tmpFile):
+                os.remove(tmpFile)
+
+    return design.astype(dtype, copy=False)
+
+
+def read_ev3_dir(evDir, names, nrOfRuns=len(NR_OF_VOLUMES)):
+    '''
+    reads the EV3 files <evDir>/run-<n>/<name>.txt of the given regressors
+    and returns a list (runs) of lists (regressors) of event arrays; a
+    missing file is treated as a regressor without events
+    '''
+    runEvents = []
+    for run in range(1, nrOfRuns + 1):
+        events = []
+        for name in names:
+            fpath = os.path.join(evDir, 'run-%i' % run, '%s.txt' % name)
+            if os.path.exists(fpath):
+                events.append(read_ev3(fpath))
+            else:
+                print('no events for %s in run %i' % (name, run))
+                events.append(np.zeros((0, 3)))
+        runEvents.append(events)
+
+    return runEvents
+
+
+def boxcars(events, nrOfSamples, dt=DT):
+    '''
+    boxcar functions of several regressors sampled every dt seconds;
+    events is a list of events x 3 arrays (onset, duration, amplitude)
+    and every event lasts at least one sample (impulses)
+    '''
+    # the boxcars are the cumulative sum of +amplitude at their start and
+    # -amplitude at their end
+    steps = np.zeros((len(events), nrOfSamples + 1))
+    for regressor, regEvents in enumerate(events):
+        starts = np.round(regEvents[:, 0] / dt).astype(int)
+        ends = np.round((regEvents[:, 0] + regEvents[:, 1]) / dt).astype(int)
+        ends = np.maximum(ends, starts + 1)
+        starts = np.clip(starts, 0, nrOfSamples)
+        ends = np.clip(ends, 0, nrOfSamples)
+        np.add.at(steps[regressor], starts, regEvents[:, 2])
+        np.add.at(steps[regressor], ends, -regEvents[:, 2])
+
+    return np.cumsum(steps, axis=1)[:, :nrOfSamples]
+
+
+def orthogonalize(columns, onto):
+    '''
+    removes from every column its projection onto the respective column
+    of onto
+    '''
+    norms = (onto * onto).sum(axis=0)
+    norms[norms == 0] = 1.0
+    betas = (columns * onto).sum(axis=0) / norms
+
+    return columns - onto * betas
+
+
+def build_designs(runEvents, nrOfVolumes=NR_OF_VOLUMES, tr=TR, dt=DT,
+                  derivatives=True):
+    '''
+    builds the design matrix (volumes x regressors, with derivatives
+    volumes x 2 * regressors) of every run; runEvents is a list (runs) of
+    lists (regressors) of events x 3 arrays with onsets relative to the
+    start of the run
+
+    the boxcars of all runs are convolved in one batched FFT convolution
+    '''
+    samplesPerVolume = int(round(tr / dt))
+    nrOfSamples = max(nrOfVolumes[:len(runEvents)]) * samplesPerVolume
+
+    # boxcars of all runs and regressors stacked (runs x regressors x time)
+    allBoxcars = np.stack([boxcars(events, nrOfSamples, dt)
+                           for events in runEvents])
+
+    hrf = double_gamma_hrf(dt)
+    kernels = [hrf]
+    if derivatives:
+        kernels.append(np.gradient(hrf))
+    kernels = np.stack(kernels)
+
+    # runs x regressors x kernels x time
+    convolved = signal.fftconvolve(allBoxcars[:, :, np.newaxis, :],
+                                   kernels[np.newaxis, np.newaxis, :, :],
+                                   axes=3)[..., :nrOfSamples]
+
+    designs = []
+    for run, volumes in enumerate(nrOfVolumes[:len(runEvents)]):
+        # sample the convolved time series at the acquisition of the volumes
+        sampled = convolved[run, :, :, :volumes * samplesPerVolume:
+                            samplesPerVolume]
+        # interleave regressors and their temporal derivatives
+        design = sampled.transpose(2, 0, 1).reshape(volumes, -1)
+        if derivatives:
+            design[:, 1::2] = orthogonalize(design[:, 1::2], design[:, 0::2])
+        designs.append(design)
+
+    return designs
+
+
+def layout_columns(design, columns, derivatives=True):
+    '''
+    puts the regressors of a built design (in the order of their events,
+    each followed by its temporal derivative) into the given columns of a
+    design laid out like FEAT's design.mat (the derivative in the next
+    column); columns without a regressor stay zero
+    '''
+    columns = np.asarray(columns, dtype=int)
+    targets = (columns[:, np.newaxis]
+               + np.arange(2 if derivatives else 1)).ravel()
+    if targets.min() < 0 or len(np.unique(targets)) != len(targets):
+        raise ValueError('overlapping or negative design columns: %s' %
+                         columns.tolist())
+
+    laidOut = np.zeros((len(design), targets.max() + 1), dtype=design.dtype)
+    laidOut[:, targets] = design
+
+    return laidOut
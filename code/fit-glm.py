@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+'''
+fits the GLM of the validation analysis (first level per run, fixed effects
+per subject, one-sample t-test across subjects) to the BOLD time series and
+writes the z-maps of the contrasts for plot-zmaps.py
+'''
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+import argparse
+import nibabel as nib
+import numpy as np
+import os
+import re
+from design import build_designs, layout_columns, read_ev3_dir
+from glm import (CONTRASTS, FixedEffects, contrast_matrix, cope_to_z,
+                 fit_run, one_sample, t_to_z, write_zmaps)
+from regressors import REGISTRY_FILE, load_registry
+
+
+def parse_arguments():
+    '''
+    '''
+    parser = argparse.ArgumentParser(
+        description='fits the GLM of the validation analysis to all voxels'
+    )
+    parser.add_argument('-b',
+                        default='inputs/sub-*/sub-*_run-?_bold.nii',
+                        help='pattern of the BOLD files (4-D NIfTI); they '
+                        'must contain sub-<n> and run-<n>')
+
+    parser.add_argument('-ev',
+                        default='events/onsets',
+                        help='directory with the EV3 files (run-<n>/<name>.txt)')
+
+    parser.add_argument('-r',
+                        default=REGISTRY_FILE,
+                        help='the table of regressors')
+
+    parser.add_argument('-o',
+                        default='glm',
+                        help='the output directory (2nd-lvl/<subject> and '
+                        '3rd-lvl)')
+
+    parser.add_argument('-t',
+                        type=float,
+                        default=3.4,
+                        help='z threshold of the thresholded maps')
+
+    parser.add_argument('-j',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='number of processes fitting the runs')
+
+    args = parser.parse_args()
+
+    boldPattern = args.b
+    evDir = args.ev
+    registryFile = args.r
+    outDir = args.o
+    threshold = args.t
+    nrOfWorkers = args.j
+
+    return boldPattern, evDir, registryFile, outDir, threshold, nrOfWorkers
+
+
+def find_runs(boldPattern):
+    '''
+    returns a dict that maps every subject to a dict of its runs (number)
+    and BOLD files
+    '''
+    runs = {}
+    for fpath in sorted(glob(boldPattern)):
+        subject = re.search(r'sub-\d+', fpath)
+        run = re.search(r'run-(\d+)', os.path.basename(fpath))
+        if subject is None or run is None:
+            print('skipping %s (no sub-<n> or run-<n>)' % fpath)
+            continue
+        runs.setdefault(subject.group(), {})[int(run.group(1))] = fpath
+
+    return runs
+
+
+if __name__ == "__main__":
+    boldPattern, evDir, registryFile, outDir, threshold, nrOfWorkers = \
+        parse_arguments()
+
+    registry = load_registry(registryFile)
+    runs = find_runs(boldPattern)
+    if not runs:
+        raise SystemExit('no BOLD files match %s' % boldPattern)
+
+    # the events of every run (the same for all subjects)
+    nrOfRuns = max(run for subjRuns in runs.values() for run in subjRuns)
+    runEvents = read_ev3_dir(evDir, registry.eventFiles, nrOfRuns)
+
+    # the design of every BOLD file (its number of volumes might differ
+    # from the nominal length of the run); every regressor is put into its
+    # design column, so that the contrasts address it
+    jobs = []
+    for subject, subjRuns in runs.items():
+        for run, fpath in sorted(subjRuns.items()):
+            nrOfVolumes = nib.load(fpath).shape[3]
+            design = layout_columns(
+                build_designs([runEvents[run - 1]], [nrOfVolumes])[0],
+                registry.designColumns)
+            jobs.append((subject, fpath, design))
+
+    contrasts = contrast_matrix(registry, jobs[0][2].shape[1])
+
+    # first level: the runs are independent; second level: fixed effects
+    # across the runs of every subject, combined as the runs' fits arrive
+    # (the jobs are ordered by subject)
+    subjCopes = []
+    with ProcessPoolExecutor(max_workers=nrOfWorkers) as executor:
+        fits = executor.map(fit_run,
+                            [fpath for subject, fpath, design in jobs],
+                            [design for subject, fpath, design in jobs],
+                            [contrasts] * len(jobs))
+
+        for subject, subjRuns in runs.items():
+            fixedEffects = FixedEffects()
+            for run in subjRuns:
+                cope, varcope, dof, affine = next(fits)
+                fixedEffects.update(cope, varcope, dof)
+
+            cope, varcope, dof = fixedEffects.result()
+            write_zmaps(os.path.join(outDir, '2nd-lvl', subject),
+                        cope_to_z(cope, varcope, dof), affine, threshold)
+            subjCopes.append(cope.astype(np.float32))
+            print('%s: %i runs, %i dof' % (subject, len(subjRuns), dof))
+
+    # third level: one-sample t-test across subjects
+    if len(subjCopes) > 1:
+        tValues, dof = one_sample(subjCopes)
+        fpathes = write_zmaps(os.path.join(outDir, '3rd-lvl'),
+                              t_to_z(tValues, dof), affine, threshold)
+        for (name, positive, negative), fpath in zip(CONTRASTS, fpathes):
+            print('%s: %s' % (name, fpath))
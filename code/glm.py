@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+'''
+voxel-wise GLM of the validation analysis: first level (runs) as batched
+least squares, fixed effects across the runs of a subject (second level) and
+a one-sample t-test across subjects (third level)
+
+every run needs one pseudo-inverse of its design; the BOLD data are read
+slab by slab (z-planes) from the image's data proxy, and every slab is
+fitted by one matrix multiplication
+'''
+import nibabel as nib
+import numpy as np
+import os
+from scipy import stats
+
+
+# contrasts of the validation analysis in the order of FEAT's copes; the
+# sides are EV3 file names or groups of the registry (all their regressors
+# are weighted equally)
+CONTRASTS = (
+    ('words > no-speech', 'tag', 'no-sp'),
+    ('no-speech > words', 'no-sp', 'tag'),
+    ('ne > kon', 'ne', 'kon'),
+    ('kon > ne', 'kon', 'ne'),
+    ('nn > kon', 'nn', 'kon'),
+    ('kon > nn', 'kon', 'nn')
+)
+
+# number of z-planes that are fitted at once
+SLAB_SIZE = 4
+
+# FEAT's directory of a cope (number) at a z threshold (see threshold_name)
+COPE_DIR = 'cope%i_z%s.gfeat'
+
+
+def contrast_matrix(registry, nrOfColumns, contrasts=CONTRASTS):
+    '''
+    weights (contrasts x design columns) of the contrasts; the regressors
+    of the positive side sum up to 1, those of the negative side to -1
+    '''
+    matrix = np.zeros((len(contrasts), nrOfColumns))
+    for row, (name, positive, negative) in enumerate(contrasts):
+        for side, sign in [(positive, 1.0), (negative, -1.0)]:
+            pos = registry.by_event_file(side)
+            if pos is not None:
+                columns = registry.designColumns[[pos]]
+            else:
+                columns = registry.designColumns[registry.groups == side]
+            if len(columns) == 0:
+                raise ValueError('contrast %r: no regressor %r' % (name, side))
+            matrix[row, columns] += sign / len(columns)
+
+    return matrix
+
+
+def fit_run(boldFile, design, contrasts, slabSize=SLAB_SIZE):
+    '''
+    fits the design (volumes x columns; an intercept is added) to every
+    voxel of a 4-D image; returns the contrasts of parameter estimates and
+    their variances (x, y, z, contrasts; float32), the degrees of freedom
+    and the affine of the image
+    '''
+    img = nib.load(boldFile)
+    shape = img.shape
+    nrOfVolumes = shape[3]
+    if len(design) != nrOfVolumes:
+        raise ValueError('%s has %i volumes, but the design %i rows' %
+                         (boldFile, nrOfVolumes, len(design)))
+
+    # FEAT demeans the regressors; the intercept takes the mean signal
+    design = np.column_stack([design - design.mean(axis=0),
+                              np.ones(nrOfVolumes)])
+    contrasts = np.column_stack([contrasts, np.zeros(len(contrasts))])
+
+    # one pseudo-inverse per run
+    pinvDesign = np.linalg.pinv(design)
+    dof = nrOfVolumes - np.linalg.matrix_rank(design)
+    # variance of every contrast per unit of residual variance
+    contrastVars = np.einsum('ij,jk,ik->i',
+                             contrasts, pinvDesign @ pinvDesign.T, contrasts)
+
+    copes = np.zeros(shape[:3] + (len(contrasts),), dtype=np.float32)
+    varcopes = np.zeros(shape[:3] + (len(contrasts),), dtype=np.float32)
+    for start in range(0, shape[2], slabSize):
+        stop = min(start + slabSize, shape[2])
+        # voxels x volumes of the slab
+        data = np.asarray(img.dataobj[:, :, start:stop, :], dtype=np.float64)
+        data = data.reshape(-1, nrOfVolumes)
+
+        betas = data @ pinvDesign.T
+        residuals = data - betas @ design.T
+        sigmas = np.einsum('ij,ij->i', residuals, residuals) / dof
+
+        slabShape = shape[:2] + (stop - start, len(contrasts))
+        copes[:, :, start:stop] = (betas @ contrasts.T).reshape(slabShape)
+        varcopes[:, :, start:stop] = np.outer(sigmas, contrastVars
+                                              ).reshape(slabShape)
+
+    return copes, varcopes, dof, img.affine
+
+
+class FixedEffects(object):
+    '''
+    combines the runs of a subject weighted by their inverse variance; the
+    runs are added one after another as their fits arrive, so that only the
+    sums (not every run's copes) are kept in memory; voxels without variance
+    (e.g. outside the brain) get 0
+    '''
+
+    def __init__(self):
+        '''
+        '''
+        self.sumWeights = None
+        self.sumWeighted = None
+        self.dof = 0
+        self.nrOfRuns = 0
+
+    def update(self, cope, varcope, dof):
+        '''
+        adds the copes and their variances of a run
+        '''
+        with np.errstate(divide='ignore'):
+            weights = 1.0 / np.asarray(varcope, dtype=np.float64)
+        weights[~np.isfinite(weights)] = 0
+
+        if self.sumWeights is None:
+            self.sumWeights = np.zeros_like(weights)
+            self.sumWeighted = np.zeros_like(weights)
+        self.sumWeights += weights
+        self.sumWeighted += weights * cope
+        self.dof += int(dof)
+        self.nrOfRuns += 1
+
+        return self
+
+    def result(self):
+        '''
+        the combined cope, its variance and the degrees of freedom
+        '''
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cope = self.sumWeighted / self.sumWeights
+            varcope = 1.0 / self.sumWeights
+
+        cope[~np.isfinite(cope)] = 0
+        varcope[~np.isfinite(varcope)] = 0
+
+        return cope, varcope, self.dof
+
+
+def one_sample(copes):
+    '''
+    t-test of the subjects' copes (first axis) against zero; returns the
+    t values and the degrees of freedom
+    '''
+    copes = np.asarray(copes)
+    nrOfSubjects = len(copes)
+    if nrOfSubjects < 2:
+        raise ValueError('a one-sample t-test needs at least 2 subjects')
+
+    stdErrs = copes.std(axis=0, ddof=1) / np.sqrt(nrOfSubjects)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tValues = copes.mean(axis=0) / stdErrs
+    tValues[~np.isfinite(tValues)] = 0
+
+    return tValues, nrOfSubjects - 1
+
+
+def t_to_z(tValues, dof):
+    '''
+    converts t values into z values of the same p value (symmetric, so that
+    large negative t values do not underflow)
+    '''
+    tValues = np.asarray(tValues, dtype=np.float64)
+    zValues = stats.norm.isf(stats.t.sf(np.abs(tValues), dof))
+
+    return np.sign(tValues) * zValues
+
+
+def cope_to_z(cope, varcope, dof):
+    '''
+    z values of a cope and its variance
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tValues = cope / np.sqrt(varcope)
+    tValues[~np.isfinite(tValues)] = 0
+
+    return t_to_z(tValues, dof)
+
+
+def threshold_name(threshold):
+    '''
+    a z threshold as it appears in the names of the cope directories (e.g.
+    3.4 -> '3.4', 3 and 3.0 -> '3'); writers and readers of the z-maps use
+    it to agree on the directory of a threshold
+    '''
+    return '%g' % float(threshold)
+
+
+def write_zmaps(outDir, zValues, affine, threshold=3.4):
+    '''
+    writes the z-map of every contrast (last axis) in FEAT's layout
+    <outDir>/cope<n>_z<threshold>.gfeat/cope1.feat/(thresh_)zstat1.nii.gz,
+    that plot-zmaps.py reads; the thresholded map keeps z > threshold
+    (voxel-wise, without FEAT's cluster correction)
+    '''
+    fpathes = []
+    for contrast in range(zValues.shape[-1]):
+        copeDir = os.path.join(outDir,
+                               COPE_DIR % (contrast + 1,
+                                           threshold_name(threshold)),
+                               'cope1.feat')
+        os.makedirs(copeDir, exist_ok=True)
+
+        zMap = zValues[..., contrast].astype(np.float32)
+        threshMap = np.where(zMap > threshold, zMap, 0).astype(np.float32)
+        for fName, values in [('zstat1.nii.gz', zMap),
+                              ('thresh_zstat1.nii.gz', threshMap)]:
+            fpath = os.path.join(copeDir, fName)
+            nib.save(nib.Nifti1Image(values, affine), fpath)
+        fpathes.append(fpath)
+
+    return fpathes
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+'''
+explanations of spaCy's labels (pos, tag, dep) without loading spaCy
+
+the explanations are read from a precomputed table (spacy_glossary.tsv);
+spaCy is only imported if a label is missing from the table. Call this
+script to regenerate the table from the installed spaCy version.
+'''
+from functools import lru_cache
+import argparse
+import csv
+import os.path
+
+
+GLOSSARY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'spacy_glossary.tsv')
+
+# flags that the annotation uses in the 'pos' column; they have no
+# explanation, but are listed in the table, so that they do not trigger
+# loading spaCy
+ANNOTATION_FLAGS = ['SENTENCE', 'NONSPEECH', 'PHONEME']
+
+
+def parse_arguments():
+    '''
+    '''
+    parser = argparse.ArgumentParser(
+        description="regenerates the table of spaCy's label explanations"
+    )
+    parser.add_argument('-o',
+                        default=GLOSSARY_FILE,
+                        help='the output file')
+
+    args = parser.parse_args()
+
+    outFile = args.o
+
+    return outFile
+
+
+@lru_cache(maxsize=None)
+def load_glossary(inFile=GLOSSARY_FILE):
+    '''
+    reads the table of label explanations into a dict
+    '''
+    if not os.path.exists(inFile):
+        return {}
+
+    with open(inFile, newline='') as tsvfile:
+        content = csv.reader(tsvfile, delimiter='\t')
+        next(content, None)
+        # an empty explanation means that the label has none
+        glossary = {label: explanation or None
+                    for label, explanation in content}
+
+    return glossary
+
+
+@lru_cache(maxsize=None)
+def explain(label, fallback=True):
+    '''
+    returns the explanation of a label (or None if there is none)
+    '''
+    glossary = load_glossary()
+    if label in glossary:
+        return glossary[label]
+
+    if not fallback:
+        return None
+
+    # label is unknown to the table (e.g. the table was generated with an
+    # older spaCy version), so ask spaCy itself
+    import spacy
+    return spacy.explain(label)
+
+
+def write_glossary(outFile):
+    '''
+    writes all explanations of spaCy's glossary to the table
+    '''
+    from spacy.glossary import GLOSSARY
+
+    with open(outFile, 'w', newline='') as tsvfile:
+        writer = csv.writer(tsvfile, delimiter='\t', lineterminator='\n')
+        writer.writerow(['label', 'explanation'])
+        for label in sorted(GLOSSARY.keys()):
+            writer.writerow([label, GLOSSARY[label]])
+        for label in ANNOTATION_FLAGS:
+            if label not in GLOSSARY:
+                writer.writerow([label, ''])
+
+
+if __name__ == "__main__":
+    outFile = parse_arguments()
+    write_glossary(outFile)
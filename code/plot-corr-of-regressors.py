@@ -3,6 +3,7 @@
 created on Sun March 29 2020
 author: Christian Olaf Haeusler
 '''
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
 import argparse
 import matplotlib
@@ -12,39 +13,14 @@ import os
 import pandas as pd
 import re
 import seaborn as sns
+from correlation import StreamingCorrelation, collinearity
+from design import (build_designs, layout_columns, read_design_mat,
+                    read_ev3_dir)
+from regressors import REGISTRY_FILE, load_registry
 matplotlib.use('Agg')
 
 
 TAG_DESIGN_PATTERN = 'sub-01/run-?_speech-validation.feat/design.mat'
-TAG_USED = list(range(1, 27)) # [1, 2, 3, 5, 6, 7, 8, 9, 10, 11, 17, 18]
-TAG_NAMES = {
-    1: 'adjective, attributive',
-    2: 'adjective, adverbial or predicative',
-    3: 'adverbial determination',
-    4: 'preposition; circumposition left',
-    5: 'preposition with article',
-    6: 'definite or indefinite article',
-    7: 'coordinate conjunction',
-    8: 'proper noun',
-    9: 'noun (singular or mass)',
-    10: 'substituting demonstrative pronoun',
-    11: 'substituting indefinite pronoun',
-    12: 'non-reflexive personal pronoun',
-    13: 'attributive possessive pronoun',
-    14: 'reflexive personal pronoun',
-    15: 'separable verbal particle',
-    16: 'finite verb,auxiliary',
-    17: 'finite verb, modal',
-    18: 'finite verb, full',
-    19: 'infinitive, full',
-    20: 'perfect participle, full',
-    21: 'other tags',
-    22: 'end of sentence',
-    23: 'phonemes',
-    24: 'no speech',
-    25: 'left-right diff',
-    26: 'root mean square'
-}
 
 
 def parse_arguments():
@@ -52,7 +28,7 @@ def parse_arguments():
     '''
     parser = argparse.ArgumentParser(
         description="creates the correlation of convoluted regressors from \
-        a subject's 1st lvl results directories (= all single run dirs ")
+        the subjects' 1st lvl results directories (= all single run dirs ")
 
 
     parser.add_argument('-exmpl',
@@ -63,20 +39,79 @@ def parse_arguments():
                         default='figures',
                         help='the output directory for the PDF and SVG file')
 
+    parser.add_argument('-ev',
+                        default=None,
+                        help='directory with the EV3 files (run-<n>/<name>.txt);'
+                        ' if given, the design is built from the events '
+                        'instead of reading the design files of FEAT')
+
+    parser.add_argument('-s',
+                        default='sub-*',
+                        help='subject(s) whose design files are used, e.g. '
+                        'sub-01 (default: all subjects)')
+
+    parser.add_argument('--per-subject',
+                        action='store_true',
+                        help='additionally write the correlation matrix of '
+                        'every subject (computed in parallel processes)')
+
+    parser.add_argument('-r',
+                        default=REGISTRY_FILE,
+                        help='the table of regressors (ids, descriptions, '
+                        'design columns, EV3 files)')
+
+    parser.add_argument('--diagnostics',
+                        action='store_true',
+                        help='also write VIFs, condition numbers and the '
+                        'eigenvalue spectra of the design (with and without '
+                        'tag_other and the temporal derivatives)')
+
+    parser.add_argument('--no-cache',
+                        action='store_true',
+                        help='do not use the binary (.npy) cache of the '
+                        'design files')
+
     args = parser.parse_args()
 
     outDir = args.o
     example = args.exmpl
+    evDir = args.ev
+    subjects = args.s
+    perSubject = args.per_subject
+    useCache = not args.no_cache
+    diagnostics = args.diagnostics
+    registryFile = args.r
 
-    return outDir, example
+    return outDir, example, evDir, subjects, perSubject, useCache, \
+        diagnostics, registryFile
 
 
-def plot_heatmap(matrix, outFpath):
+def correlate_designs(fpathes, columns, useCache=True):
     '''
+    accumulates the correlation of the columns over the design files, reading
+    one file at a time
     '''
-    # generate a mask for the upper triangle
-    mask = np.zeros_like(matrix, dtype=np.bool)
+    correlation = StreamingCorrelation(len(columns))
+    for fpath in fpathes:
+        correlation.update(read_design_mat(fpath, useCache)[:, columns])
+
+    return correlation
+
+
+def plot_heatmap(matrix, outFpath, grayed=(), annotMax=30, annotMin=0.3):
+    '''
+    plots the lower triangle of the correlation matrix as one image; cells
+    are annotated if the matrix has at most annotMax rows, otherwise only
+    cells with an absolute correlation of at least annotMin; the labels of
+    the regressors in grayed are printed in gray
+    '''
+    values = np.asarray(matrix, dtype=np.float64)
+    nrOfRows = len(values)
+
+    # mask the upper triangle
+    mask = np.zeros_like(values, dtype=bool)
     mask[np.triu_indices_from(mask)] = True
+    masked = np.ma.masked_array(values, mask=mask)
 
     # set up the matplotlib figure
     f, ax = plt.subplots(figsize=(11, 9))
@@ -84,72 +119,196 @@ def plot_heatmap(matrix, outFpath):
     # custom diverging colormap
     cmap = sns.diverging_palette(220, 10, sep=1, as_cmap=True)
 
-    # draw the heatmap with the mask and correct aspect ratio
-    sns_plot = sns.heatmap(matrix, mask=mask,
-                           cmap=cmap,
-                           square=True,
-                           center = 0,
-                           vmin=-1.0, vmax=1,
-                           annot=True, annot_kws={"size": 8}, fmt='.1f',
-                           #linewidths=.5,
-                           cbar_kws={"shrink": .6}
-                           )
+    # draw the lower triangle as a single image artist
+    image = ax.imshow(masked, cmap=cmap, vmin=-1.0, vmax=1.0,
+                      interpolation='nearest', aspect='equal')
+    f.colorbar(image, ax=ax, shrink=.6)
+    for spine in ax.spines.values():
+        spine.set_visible(False)
+
+    # annotate the cells (all or the strong correlations only)
+    annotate = ~mask & ~np.isnan(values)
+    if nrOfRows > annotMax:
+        annotate &= np.abs(values) >= annotMin
+    # dark cells get white text, light cells black text
+    colors = image.to_rgba(values)
+    luminance = colors[..., :3] @ np.array([.2126, .7152, .0722])
+    for y, x in zip(*np.nonzero(annotate)):
+        ax.text(x, y, '%.1f' % values[y, x], size=8,
+                ha='center', va='center',
+                color='black' if luminance[y, x] > .408 else 'white')
+
+    ax.set_xticks(np.arange(nrOfRows))
+    ax.set_yticks(np.arange(nrOfRows))
+    ax.set_xticklabels(matrix.columns, rotation=90, fontsize=12)
+    ax.set_yticklabels(matrix.index, rotation=0, fontsize=12)
+    ax.tick_params(length=0)
+
+    # black = default
+    for labels in [ax.get_xticklabels(), ax.get_yticklabels()]:
+        for label in labels:
+            if label.get_text() in grayed:
+                label.set_color('gray')
+
+    os.makedirs(outFpath, exist_ok=True)
+
+    # compute the layout once and reuse it for both formats
+    bbox = f.get_tightbbox(f.canvas.get_renderer()).padded(0.1)
+    file_name = os.path.join(outFpath, 'regressor-corr.%s')
+    for ext in ['svg', 'pdf']:
+        f.savefig(file_name % ext, bbox_inches=bbox, transparent=True)
+    plt.close(f)
 
-    plt.xticks(rotation=90, fontsize=12)
-    plt.yticks(rotation=0, fontsize=12)
 
-    for x in range(0, 21):
-        plt.gca().get_xticklabels()[x].set_color('black') #  black = default
+def diagnostics_configs(sources, isDerivative, tagOtherColumn):
+    '''
+    masks of the columns of the design configurations to check; sources
+    holds the design column of the regressor every column belongs to (the
+    regressor itself or its temporal derivative, marked by isDerivative)
+    '''
+    isDerivative = np.asarray(isDerivative, dtype=bool)
+    isTagOther = np.asarray(sources) == tagOtherColumn
 
-    for x in range(21, 26):
-        plt.gca().get_xticklabels()[x].set_color('gray')
+    configs = {'all': np.ones(len(isDerivative), dtype=bool),
+               'no-tag-other': ~isTagOther}
+    if isDerivative.any():
+        configs['no-derivatives'] = ~isDerivative
+        configs['no-tag-other-no-derivatives'] = ~isTagOther & ~isDerivative
 
-    for y in range(21, 26):
-        plt.gca().get_yticklabels()[y].set_color('gray')
+    return configs
 
-    for y in range(0, 21):
-        plt.gca().get_yticklabels()[y].set_color('black')
+
+def write_diagnostics(corrMat, names, configs, outFpath):
+    '''
+    writes VIFs and condition numbers (TSV) and plots the eigenvalue spectra
+    of the configurations; columns without variance are left out of the
+    diagnostics and listed in the summary
+    '''
+    vifs, conditions, spectra, dropped = collinearity(corrMat, configs)
 
     os.makedirs(outFpath, exist_ok=True)
+    file_name = os.path.join(outFpath, 'regressor-%s')
 
-    file_name = os.path.join(outFpath, 'regressor-corr.%s')
-    f.savefig(file_name % 'svg', bbox_inches='tight', transparent=True)
-    f.savefig(file_name % 'pdf', bbox_inches='tight', transparent=True)
-    plt.close()
+    vifs = pd.DataFrame(vifs.T, index=names, columns=list(configs.keys()))
+    vifs.to_csv(file_name % 'vif.tsv', sep='\t', float_format='%.2f')
+
+    summary = pd.DataFrame({
+        'columns': [mask.sum() - isDropped.sum()
+                    for mask, isDropped in zip(configs.values(), dropped)],
+        'condition_number': conditions,
+        'max_vif': vifs.max().values,
+        'min_eigenvalue': [spectrum[-1] for spectrum in spectra.values()],
+        'dropped': ['; '.join(np.asarray(names)[isDropped]) or '-'
+                    for isDropped in dropped]},
+        index=list(configs.keys()))
+    summary.to_csv(file_name % 'collinearity.tsv', sep='\t',
+                   float_format='%.4g')
+
+    f, ax = plt.subplots(figsize=(6, 4))
+    for config, spectrum in spectra.items():
+        ax.plot(np.arange(1, len(spectrum) + 1), spectrum, marker='.',
+                label='%s (cond. %.1f)' % (config, summary.condition_number[config]))
+    ax.set_yscale('log')
+    ax.set_xlabel('component')
+    ax.set_ylabel('eigenvalue of the correlation matrix')
+    ax.legend(fontsize=8)
+    f.savefig(file_name % 'eigenvalues.svg', bbox_inches='tight',
+              transparent=True)
+    plt.close(f)
+
+    print(summary.drop(columns='dropped').to_string())
+    for config, isDropped in zip(configs.keys(), dropped):
+        if isDropped.any():
+            print('%s: left out (no variance): %s' %
+                  (config, '; '.join(np.asarray(names)[isDropped])))
 
 
 if __name__ == "__main__":
-    outDir, designExample = parse_arguments()
+    outDir, designExample, evDir, subjects, perSubject, useCache, \
+        diagnostics, registryFile = parse_arguments()
+
+    registry = load_registry(registryFile)
 
     # from example, create the pattern to find design files for all runs
     run = re.search('run-\d', designExample)
     run = run.group()
     designPattern = designExample.replace(run, 'run-*')
 
-    # just in case, create substitute random subject for sub-01
+    # substitute the example's subject with the requested subject(s)
     subj = re.search('sub-\d{2}', designExample)
     subj = subj.group()
-    designPattern = designPattern.replace(subj, 'sub-01')
+    designPattern = designPattern.replace(subj, subjects)
 
-    # get design.mat files for the 8 runs
+    # get design.mat files for the 8 runs (of all requested subjects)
     designFpathes = sorted(glob(designPattern))
-    # specify which columns of the design file to use
-    # correct for python index starting at 0
-    # & use every 2nd column because odd numbered columns
-    # in the design file are temporal derivatives
-    tag_columns = [(x-1) * 2 for x in TAG_USED]
-    tag_names = [TAG_NAMES[x] for x in TAG_USED]
-
-    # read the all 8 design files and concatenate
-    all_df = pd.concat([pd.read_csv(
-        run,
-        usecols=tag_columns,
-        names=tag_names,
-        skiprows=5, sep='\t')
-        for run in designFpathes], ignore_index=True)
+    # specify which columns of the design file to use; the registry holds
+    # the column of every regressor (odd numbered columns in the design
+    # file are temporal derivatives)
+    used = registry.select()
+    tag_columns = registry.designColumns[used].tolist()
+    tag_names = [registry.descriptions[pos] for pos in used]
+
+    if diagnostics:
+        # the diagnostics also need the temporal derivatives
+        pairs = [(column, deriv) for column in tag_columns
+                 for deriv in (0, 1)]
+        columns = [column + deriv for column, deriv in pairs]
+        sources = [column for column, deriv in pairs]
+        isDerivative = [deriv == 1 for column, deriv in pairs]
+        names = [name + deriv for name in tag_names
+                 for deriv in ('', ' (temp. deriv.)')]
+    else:
+        columns, names = tag_columns, tag_names
+    # position of the regressors (without derivatives) in the columns
+    isTag = np.isin(columns, tag_columns)
+
+    if evDir is not None:
+        # convolve the events of all 8 runs & accumulate the design matrices
+        # (every regressor put into its column as in the design files)
+        runEvents = read_ev3_dir(evDir, registry.eventFiles)
+        regCorr = StreamingCorrelation(len(columns))
+        for design in build_designs(runEvents):
+            design = layout_columns(design, registry.designColumns)
+            regCorr.update(design[:, columns])
+    elif perSubject:
+        # correlate every subject's runs in its own process & merge them
+        bySubject = {}
+        for fpath in designFpathes:
+            subject = re.search('sub-\d+', fpath).group()
+            bySubject.setdefault(subject, []).append(fpath)
+
+        with ProcessPoolExecutor() as executor:
+            subjCorrs = list(executor.map(correlate_designs,
+                                          bySubject.values(),
+                                          [columns] * len(bySubject),
+                                          [useCache] * len(bySubject)))
+
+        os.makedirs(outDir, exist_ok=True)
+        regCorr = StreamingCorrelation(len(columns))
+        for subject, subjCorr in zip(bySubject.keys(), subjCorrs):
+            subjCorrMat = pd.DataFrame(subjCorr.correlation()[isTag][:, isTag],
+                                       index=tag_names, columns=tag_names)
+            subjCorrMat.to_csv(
+                os.path.join(outDir, 'regressor-corr_%s.tsv' % subject),
+                sep='\t', float_format='%.4f')
+            regCorr.merge(subjCorr)
+    else:
+        # read the design files one by one & accumulate their correlation
+        regCorr = correlate_designs(designFpathes, columns, useCache)
 
     # create the correlation matrix for all columns
-    regCorrMat = all_df.corr()
+    corrMat = regCorr.correlation()
+    regCorrMat = pd.DataFrame(corrMat[isTag][:, isTag],
+                              index=tag_names, columns=tag_names)
 
     # plot it
-    plot_heatmap(regCorrMat, outDir)
+    plot_heatmap(regCorrMat, outDir,
+                 grayed=[registry.descriptions[pos] for pos in used
+                         if registry.groups[pos] != 'tag'])
+
+    if diagnostics:
+        tagOther = registry.by_event_file('tag_other')
+        configs = diagnostics_configs(
+            sources, isDerivative,
+            registry.designColumns[tagOther] if tagOther is not None else -1)
+        write_diagnostics(corrMat, names, configs, outDir)
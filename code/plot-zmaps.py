@@ -5,11 +5,19 @@ created on Wednesday February 27 2020
 '''
 
 
-from nilearn import plotting
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from glob import glob
+from itertools import repeat
+from nilearn import image, plotting
 import matplotlib.pyplot as plt
 import matplotlib as mpl
+import numpy as np
 import argparse
 import os
+import re
+import slices
+from glm import COPE_DIR, threshold_name
 
 
 # anatImg = '/usr/share/fsl/5.0/data/standard/MNI152_T1_1mm.nii.gz'
@@ -18,17 +26,35 @@ anatImg = '/usr/share/data/fsl-mni152-templates/MNI152_T1_0.5mm.nii.gz'
 # T2* EPI group template
 audioMask = 'code/fov_tmpl_0.5.nii.gz'
 
-# list of primary contrasts
-# words > no-speech (bottom), Ne > kon (middle), Nn > kon (top image)
-primCopes = ['cope1_z3.4.gfeat/cope1.feat/thresh_zstat1.nii.gz',
-             'cope3_z3.4.gfeat/cope1.feat/thresh_zstat1.nii.gz',
-             'cope5_z3.4.gfeat/cope1.feat/thresh_zstat1.nii.gz']
+# thresholded z-map of a cope (number) at a z threshold
+COPE_PATTERN = os.path.join(COPE_DIR, 'cope1.feat', 'thresh_zstat1.nii.gz')
 
-# list of corresponding reverse contrasts
-# No-sp > words, Kon > ne, Kon > nn
-reveCopes = ['cope2_z3.4.gfeat/cope1.feat/thresh_zstat1.nii.gz',
-             'cope4_z3.4.gfeat/cope1.feat/thresh_zstat1.nii.gz',
-             'cope6_z3.4.gfeat/cope1.feat/thresh_zstat1.nii.gz']
+# z threshold of the paper's figure
+THRESHOLD = 3.4
+
+# formats of the figures & resolution of their anatomical/overlay layers
+FORMATS = ['svg', 'pdf']
+DPI = 150
+
+# loaded volumes kept in memory: the ones of one figure (template, FoV
+# mask and three z-maps); the z-maps of the next figure replace the least
+# recently used ones, while the template and the mask (used by every
+# panel) stay
+CACHED_VOLUMES = 5
+
+# default number of processes in batch mode; every process keeps its own
+# cache (about 1.2 GB for five float32 volumes of 0.5 mm), so the default
+# does not grow with the number of CPUs
+NR_OF_WORKERS = 2
+
+# labels of the primary and the reverse contrasts (bottom, middle, top)
+primLabels = ['words > no-speech',
+              'proper nouns > coord. conjunctions',
+              'nouns > coord. conjunctions']
+
+reveLabels = ['no-speech > words',
+              'coord. conjunctions > proper nouns',
+              'coord. conjunctions > nouns']
 
 
 def parse_arguments():
@@ -46,25 +72,106 @@ def parse_arguments():
                         default='paper/figures/',
                         help='output dir for zmaps & colorbars')
 
+    parser.add_argument('-t',
+                        type=float,
+                        default=THRESHOLD,
+                        help='z threshold of the maps')
+
+    parser.add_argument('--batch',
+                        action='store_true',
+                        help='render the primary and reverse contrasts at '
+                        'every threshold found in the 3rd lvl directory and '
+                        'in the subjects\' 2nd lvl directories')
+
+    parser.add_argument('-s',
+                        default=None,
+                        help='directory that contains the 2nd lvl directories '
+                        'of the subjects (sub-*; default: 2nd-lvl next to '
+                        'the 3rd lvl directory); used with --batch')
+
+    parser.add_argument('-f',
+                        nargs='+',
+                        default=FORMATS,
+                        help='formats of the figures (all written from one '
+                        'layout), e.g. svg pdf png')
+
+    parser.add_argument('--dpi',
+                        type=int,
+                        default=DPI,
+                        help='resolution of the rasterized brain slices '
+                        '(text and colorbars stay vector graphics)')
+
+    parser.add_argument('--fast',
+                        action='store_true',
+                        help='cut only the shown planes out of the volumes '
+                        'and composite them in NumPy instead of plotting '
+                        'the volumes with nilearn')
+
+    parser.add_argument('-j',
+                        type=int,
+                        default=min(NR_OF_WORKERS, os.cpu_count()),
+                        help='number of processes rendering figures in batch '
+                        'mode (each holds up to %i volumes in memory)'
+                        % CACHED_VOLUMES)
+
     args = parser.parse_args()
 
     inDir = args.d
     outFile = args.o
+    threshold = args.t
+    batch = args.batch
+    subjDir = args.s
+    if subjDir is None:
+        subjDir = os.path.join(os.path.dirname(os.path.normpath(inDir)),
+                               '2nd-lvl')
+    nrOfWorkers = args.j
+    formats = args.f
+    dpi = args.dpi
+    fast = args.fast
+
+    return inDir, outFile, threshold, batch, subjDir, nrOfWorkers, formats, \
+        dpi, fast
+
+
+@lru_cache(maxsize=CACHED_VOLUMES)
+def load_volume(fpath):
+    '''
+    loads a NIfTI image once and resamples it once to the voxel grid that
+    nilearn plots on (RAS, diagonal affine); the data stay in memory, so the
+    panels of a figure reuse the image instead of loading and resampling
+    the file again
+    '''
+    img = image.load_img(fpath)
+    data = img.get_fdata(dtype=np.float32)
+    # nilearn resamples binary images (e.g. masks) with nearest neighbours
+    isBinary = ((data == 0) | (data == 1)).all()
+    del data
+    img = image.reorder_img(img,
+                            resample='nearest' if isBinary else 'continuous')
+    # keep the data as float32 array (half the memory of get_fdata()'s
+    # float64); nilearn plots the image's array without converting it
+    img = image.new_img_like(img, img.get_fdata(dtype=np.float32),
+                             copy_header=True)
 
-    return inDir, outFile
+    return img
 
 
 def process_group_averages(outfpath, imageList=
                            ['cope1_z3.4.gfeat/cope1.feat/thresh_zstat1.nii.gz',
                             'cope3_z3.4.gfeat/cope1.feat/thresh_zstat1.nii.gz',
-                            'cope3_z3.4.gfeat/cope1.feat/thresh_zstat1.nii.gz']
-                           ):
+                            'cope3_z3.4.gfeat/cope1.feat/thresh_zstat1.nii.gz'],
+                           threshold=THRESHOLD, labels=primLabels,
+                           title='3rd lvl group analysis',
+                           formats=FORMATS, dpi=DPI, fast=False):
     '''
     '''
+    # nilearn's displays or the plane extraction of slices.py
+    plot_slice = plot_fast_slice if fast else plot_grp_slice
+
     bottomImg = imageList[0]
     middleImg = imageList[1]
     topImg = imageList[2]
-    print('creating plot for 3rd lvl group analysis')
+    print('creating plot for %s' % title)
 
     fsize = (15, 15)
     fig = plt.figure(figsize=fsize, constrained_layout=False)
@@ -80,25 +187,26 @@ def process_group_averages(outfpath, imageList=
     axis = fig.add_subplot(grid[0:12, 0:3])
     mode = 'z'  # axial/horizontal slice
     coord = [9]
-    plot_grp_slice(mode, coord,
-                   bottomImg, middleImg, topImg,
-                   title='Z>3.4, p<0.05', axis=axis)
+    plot_slice(mode, coord,
+               bottomImg, middleImg, topImg,
+               title='Z>%s, p<0.05' % threshold, axis=axis,
+               threshold=threshold)
 
     # plot coronal plane
     axis = fig.add_subplot(grid[0:12, 3:])
     mode = 'y'
     coord = [-18]
-    plot_grp_slice(mode, coord,
-                   bottomImg, middleImg, topImg,
-                   axis=axis)
+    plot_slice(mode, coord,
+               bottomImg, middleImg, topImg,
+               axis=axis, threshold=threshold)
 
     # plot left sagittal plane
     axis = fig.add_subplot(grid[12:24, 0:3])
     mode = 'x'
     coord = [-55]
-    plot_grp_slice(mode, coord,
-                   bottomImg, middleImg, topImg,
-                   axis=axis)
+    plot_slice(mode, coord,
+               bottomImg, middleImg, topImg,
+               axis=axis, threshold=threshold)
     # mirror horizontally
     plt.gca().invert_xaxis()
 
@@ -106,13 +214,13 @@ def process_group_averages(outfpath, imageList=
     axis = fig.add_subplot(grid[12:24, 3:])
     mode = 'x'
     coord = [55]
-    plot_grp_slice(mode, coord,
-                   bottomImg, middleImg, topImg,
-                   axis=axis)
+    plot_slice(mode, coord,
+               bottomImg, middleImg, topImg,
+               axis=axis, threshold=threshold)
 
     # text for z threshold and significance level
     plt.text(-330, 285,
-             'Z>3.4, p<0.05',  # title=subject
+             'Z>%s, p<0.05' % threshold,  # title=subject
              size=16,
              color='white',
              backgroundcolor='black',
@@ -125,11 +233,11 @@ def process_group_averages(outfpath, imageList=
 
     # manually, add a legend in bottom, right plot (right sagittal plane
     blue = mpl.patches.Patch(color='blue',
-                             label='words > no-speech')
+                             label=labels[0])
     red = mpl.patches.Patch(color='red',
-                            label='proper nouns > coord. conjunctions',)
+                            label=labels[1],)
     green = mpl.patches.Patch(color='green',
-                              label='nouns > coord. conjunctions')
+                              label=labels[2])
 
     legendAxis.legend(handles=[blue, red, green],
                       loc='center',
@@ -145,7 +253,7 @@ def process_group_averages(outfpath, imageList=
     cb1Axis = fig.add_subplot(grid[24, 3:])
     cmap = mpl.cm.Blues
     cmap = cmap.reversed()
-    norm = mpl.colors.Normalize(vmin=3.4, vmax=6.6)
+    norm = mpl.colors.Normalize(vmin=threshold, vmax=6.6)
     cb1 = mpl.colorbar.ColorbarBase(cb1Axis,
                                     cmap=cmap,
                                     norm=norm,
@@ -159,7 +267,7 @@ def process_group_averages(outfpath, imageList=
     cb2Axis = fig.add_subplot(grid[25, 3:])
     cmap = mpl.cm.YlOrRd
     cmap = cmap.reversed()
-    norm = mpl.colors.Normalize(vmin=3.4, vmax=6.6)
+    norm = mpl.colors.Normalize(vmin=threshold, vmax=6.6)
     cb2 = mpl.colorbar.ColorbarBase(cb2Axis,
                                     cmap=cmap,
                                     norm=norm,
@@ -176,7 +284,7 @@ def process_group_averages(outfpath, imageList=
     cb3Axis = fig.add_subplot(grid[26, 3:])
     cmap = mpl.cm.Greens
     cmap = cmap.reversed()
-    norm = mpl.colors.Normalize(vmin=3.4, vmax=6.6)
+    norm = mpl.colors.Normalize(vmin=threshold, vmax=6.6)
     cb3 = mpl.colorbar.ColorbarBase(cb3Axis,
                                     cmap=cmap,
                                     norm=norm,
@@ -189,32 +297,42 @@ def process_group_averages(outfpath, imageList=
     # set space between subplots and outer edge to black
     fig.patch.set_facecolor('black')
 
-    # save as SVG
-    svgOut = outfpath + '.svg'
-    plt.savefig(svgOut,
-                bbox_inches='tight',
-                pad_inches=0,
-                facecolor=fig.get_facecolor())
-
-    # save as PDF
-    pdfOut = outfpath + '.pdf'
-    plt.savefig(pdfOut,
-                transparent=True,
-                pad_inches=0,
-                facecolor=fig.get_facecolor())
+    export_figure(fig, outfpath, formats, dpi)
 
     plt.close()
 
 
+def export_figure(fig, outfpath, formats=FORMATS, dpi=DPI):
+    '''
+    writes the figure in all formats from one layout; the images of the
+    slices (template, mask and z-maps) are merged into one bitmap per slice
+    at the given resolution, while text and colorbars stay vectors
+    '''
+    # images are drawn at zorder 0, annotations above
+    for ax in fig.axes:
+        if ax.get_images():
+            ax.set_rasterization_zorder(1)
+
+    # compute the tight bounding box once instead of once per format
+    bbox = fig.get_tightbbox(fig.canvas.get_renderer())
+
+    for ext in formats:
+        fig.savefig('%s.%s' % (outfpath, ext),
+                    bbox_inches=bbox,
+                    pad_inches=0,
+                    dpi=dpi,
+                    facecolor=fig.get_facecolor())
+
+
 def plot_grp_slice(mode, coord,
                    bottomImg, middleImg, topImg, axis,
-                   title=None, annoBool=True):
+                   title=None, annoBool=True, threshold=THRESHOLD):
     '''
     '''
     # underlying MNI152 T1 0.5mm image
     colorMap = plt.cm.get_cmap('Greys')
     colorMap = colorMap.reversed()
-    display = plotting.plot_anat(anat_img=anatImg,
+    display = plotting.plot_anat(anat_img=load_volume(anatImg),
                                  axes=axis,
                                  # title=title,
                                  # annotate=annoBool,
@@ -225,43 +343,151 @@ def plot_grp_slice(mode, coord,
     display.annotate(size=16)
 
     # brain mask 'grbold7Tad' in MNI space aligned with 12dof
-    display.add_overlay(audioMask,
+    display.add_overlay(load_volume(audioMask),
                         cmap=colorMap,
                         alpha=.9)
 
     # bottom z-map
     colorMap = plt.cm.get_cmap('Blues')
     colorMap = colorMap.reversed()
-    display.add_overlay(bottomImg,
-                        threshold=3.4,
+    display.add_overlay(load_volume(bottomImg),
+                        threshold=threshold,
                         cmap=colorMap,  # plotting.cm.black_blue,
-                        vmin=3.4,
+                        vmin=threshold,
                         vmax=6.6,
                         alpha=1.0)
 
     # middle z-map
     colorMap = plt.cm.get_cmap('YlOrRd')
     colorMap = colorMap.reversed()
-    display.add_overlay(middleImg,
-                        threshold=3.4,
+    display.add_overlay(load_volume(middleImg),
+                        threshold=threshold,
                         cmap=colorMap,
-                        vmin=3.4,
+                        vmin=threshold,
                         vmax=6.6,
                         alpha=1.0)
 
     # top z-map
     colorMap = plt.cm.get_cmap('Greens')
     colorMap = colorMap.reversed()
-    display.add_overlay(topImg,
-                        threshold=3.4,
+    display.add_overlay(load_volume(topImg),
+                        threshold=threshold,
                         cmap=colorMap,  # plotting.cm.red_transparent,
-                        vmin=3.4,
+                        vmin=threshold,
                         vmax=6.6,
                         alpha=1.0)
 
     return display
 
 
+def init_worker():
+    '''
+    sets up matplotlib in a worker process of the batch mode
+    '''
+    mpl.use('Agg')
+    # set the background of all figures (for saving) to black
+    plt.rcParams['savefig.facecolor'] = 'black'
+    plt.rcParams['axes.facecolor'] = 'black'
+
+
+def find_thresholds(copeDir):
+    '''
+    z thresholds of the cope directories (cope<n>_z<threshold>.gfeat)
+    '''
+    thresholds = set()
+    for dirName in os.listdir(copeDir):
+        match = re.fullmatch(r'cope\d+_z([\d.]+)\.gfeat', dirName)
+        if match:
+            thresholds.add(match.group(1))
+
+    return sorted(thresholds, key=float)
+
+
+def figure_jobs(copeDir, outDir, prefix='', title='3rd lvl group analysis'):
+    '''
+    jobs (output file, z-maps, threshold, labels, title) of the primary and
+    the reverse contrasts at every threshold that has all three maps
+    '''
+    jobs = []
+    for threshold in find_thresholds(copeDir):
+        for copes, labels, suffix in [((1, 3, 5), primLabels, ''),
+                                      ((2, 4, 6), reveLabels, '-reverse')]:
+            inFpathes = [os.path.join(copeDir, COPE_PATTERN % (cope, threshold))
+                         for cope in copes]
+            if not all(os.path.exists(fpath) for fpath in inFpathes):
+                continue
+
+            fName = prefix + 'slicescolorbars' + suffix
+            if float(threshold) != THRESHOLD:
+                fName += '_z%s' % threshold
+            jobs.append((os.path.join(outDir, fName), inFpathes,
+                         float(threshold), labels, title))
+
+    return jobs
+
+
+def is_up_to_date(outFile, inFpathes, formats=FORMATS):
+    '''
+    True if the figures of all formats are newer than all inputs
+    '''
+    outFpathes = ['%s.%s' % (outFile, ext) for ext in formats]
+    if not all(os.path.exists(fpath) for fpath in outFpathes):
+        return False
+
+    inTime = max(os.path.getmtime(fpath) for fpath in inFpathes
+                 if os.path.exists(fpath))
+
+    return min(os.path.getmtime(fpath) for fpath in outFpathes) > inTime
+
+
+def render_job(job, formats=FORMATS, dpi=DPI, fast=False):
+    '''
+    renders the figure of a job (in a worker process)
+    '''
+    outFile, inFpathes, threshold, labels, title = job
+    process_group_averages(outFile, inFpathes, threshold, labels, title,
+                           formats, dpi, fast)
+    plt.close('all')
+
+    return outFile
+
+
+def plot_fast_slice(mode, coord,
+                    bottomImg, middleImg, topImg, axis,
+                    title=None, annoBool=True, threshold=THRESHOLD):
+    '''
+    same layers as plot_grp_slice, but only the shown plane of every
+    volume is read, colormapped and composited into one RGBA image
+    '''
+    layers = [(anatImg, {'cmap': plt.get_cmap('Greys').reversed()}),
+              (audioMask, {'cmap': plt.get_cmap('Greys').reversed(),
+                           'threshold': 1e-6, 'alpha': .9})]
+    for img, cmapName in [(bottomImg, 'Blues'),
+                          (middleImg, 'YlOrRd'),
+                          (topImg, 'Greens')]:
+        layers.append((img, {'cmap': plt.get_cmap(cmapName).reversed(),
+                             'threshold': threshold,
+                             'vmin': threshold, 'vmax': 6.6}))
+
+    rgba, extent = slices.render_plane(mode, coord[0], layers)
+
+    axis.imshow(rgba, origin='lower', extent=extent,
+                interpolation='nearest', aspect='equal')
+    axis.set_facecolor('black')
+    axis.axis('off')
+
+    # annotate the cut & the hemispheres like nilearn's displays
+    axis.text(.02, .02, '%s=%i' % (mode, coord[0]),
+              transform=axis.transAxes, size=16, color='white')
+    if mode in ('y', 'z'):
+        axis.text(.02, .95, 'L', transform=axis.transAxes, size=16,
+                  color='white')
+        axis.text(.95, .95, 'R', transform=axis.transAxes, size=16,
+                  color='white')
+
+    return axis
+
+
 # main program #
 if __name__ == "__main__":
     # set the background of all figures (for saving) to black
@@ -269,15 +495,40 @@ if __name__ == "__main__":
     plt.rcParams['axes.facecolor'] = 'black'
 
     # get the command line arguments
-    inDir, outDir = parse_arguments()
-
-    inFpathes = [os.path.join(inDir, cope) for cope in primCopes]
+    inDir, outDir, threshold, batch, subjDir, nrOfWorkers, formats, dpi, \
+        fast = parse_arguments()
 
     os.makedirs(os.path.dirname(outDir), exist_ok=True)
 
-    # plotting stacked zmaps
-    fName = 'slicescolorbars'
-    outFile = os.path.join(outDir, fName)
-    process_group_averages(outFile, inFpathes)
+    if batch:
+        # group maps & the maps of every subject
+        jobs = figure_jobs(inDir, outDir)
+        for subjCopeDir in sorted(glob(os.path.join(subjDir, 'sub-*'))):
+            subject = os.path.basename(subjCopeDir)
+            jobs.extend(figure_jobs(subjCopeDir, outDir, subject + '_',
+                                    '2nd lvl of %s' % subject))
+
+        # skip figures that are newer than their z-maps (and the template)
+        todo = [job for job in jobs
+                if not is_up_to_date(job[0], job[1] + [anatImg, audioMask],
+                                     formats)]
+        print('rendering %i of %i figures' % (len(todo), len(jobs)))
+
+        with ProcessPoolExecutor(max_workers=nrOfWorkers,
+                                 initializer=init_worker) as executor:
+            for outFile in executor.map(render_job, todo,
+                                        repeat(formats), repeat(dpi),
+                                        repeat(fast)):
+                print('wrote %s' % outFile)
+    else:
+        inFpathes = [os.path.join(inDir, COPE_PATTERN %
+                                  (cope, threshold_name(threshold)))
+                     for cope in (1, 3, 5)]
+
+        # plotting stacked zmaps
+        fName = 'slicescolorbars'
+        outFile = os.path.join(outDir, fName)
+        process_group_averages(outFile, inFpathes, threshold,
+                               formats=formats, dpi=dpi, fast=fast)
 
     plt.close('all')
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+'''
+registry of the regressors of the first level GLM
+
+the regressors are listed in a table (regressors.tsv) that maps the id of
+every regressor to its label, its description (as printed in figures), its
+column in FEAT's design.mat, the name of its EV3 file, its group ('tag',
+'speech' or 'audio') and whether it is used in the figures; a new model
+variant only needs a new table
+'''
+from functools import lru_cache
+import csv
+import numpy as np
+import os.path
+
+
+REGISTRY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'regressors.tsv')
+
+
+class Registry(object):
+    '''
+    the columns of the table as lists/arrays (in the order of the table)
+    plus dicts that map ids and EV3 file names to the position of their
+    regressor; lookups of several regressors return index arrays
+    '''
+
+    def __init__(self, rows):
+        '''
+        '''
+        self.ids = np.array([int(row['id']) for row in rows], dtype=int)
+        self.labels = [row['label'] for row in rows]
+        self.descriptions = [row['description'] for row in rows]
+        self.designColumns = np.array([int(row['design_column'])
+                                       for row in rows], dtype=int)
+        self.eventFiles = [row['event_file'] for row in rows]
+        self.groups = np.array([row['group'] for row in rows])
+        self.used = np.array([row['used'] == '1' for row in rows], dtype=bool)
+
+        self.positions = {regId: pos for pos, regId in
+                          enumerate(self.ids.tolist())}
+        self.filePositions = {eventFile: pos for pos, eventFile in
+                              enumerate(self.eventFiles)}
+        self.usedIdx = np.flatnonzero(self.used)
+
+    def __len__(self):
+        '''
+        '''
+        return len(self.ids)
+
+    def select(self, ids=None):
+        '''
+        positions of the regressors with the given ids (default: the used
+        regressors)
+        '''
+        if ids is None:
+            return self.usedIdx
+
+        return np.array([self.positions[regId] for regId in ids], dtype=int)
+
+    def by_event_file(self, eventFile):
+        '''
+        position of the regressor of an EV3 file (None if not registered)
+        '''
+        return self.filePositions.get(eventFile)
+
+
+@lru_cache(maxsize=None)
+def load_registry(inFile=REGISTRY_FILE):
+    '''
+    reads the table of regressors
+    '''
+    with open(inFile, newline='') as tsvfile:
+        rows = list(csv.DictReader(tsvfile, delimiter='\t'))
+
+    return Registry(rows)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+'''
+timing of the eight stimulus segments (= fMRI runs) of the audio-description
+and a lookup of the segment an annotated event belongs to
+'''
+import bisect
+import numpy as np
+
+
+SEGMENTS_OFFSETS = (
+    (0.00, 0.00),
+    (886.00, 0.00),
+    (1752.08, 0.08),  # third segment's start
+    (2612.16, 0.16),
+    (3572.20, 0.20),
+    (4480.28, 0.28),
+    (5342.36, 0.36),
+    (6410.44, 0.44),  # last segment's start
+    (7086.00, 0.00))  # movie's last time point
+
+
+class SegmentIndex(object):
+    '''
+    maps onsets (seconds from stimulus onset) to the number of the segment
+    (1-8) they fall into; the boundaries are computed once, and a single
+    lookup is a binary search instead of a scan over all segment starts
+    '''
+
+    def __init__(self, segmentsOffsets=SEGMENTS_OFFSETS):
+        '''
+        '''
+        self.starts = [start for start, offset in segmentsOffsets]
+        self.offsets = [offset for start, offset in segmentsOffsets]
+        self.startsArray = np.array(self.starts, dtype=np.float64)
+        self.offsetsArray = np.array(self.offsets, dtype=np.float64)
+
+    def segment(self, onset):
+        '''
+        returns the segment of a single onset
+        '''
+        run = bisect.bisect_right(self.starts, float(onset)) - 1
+        if run < 0:
+            raise ValueError('onset %s is before the first segment' % onset)
+
+        return run + 1
+
+    def segments(self, onsets):
+        '''
+        vectorized lookup: takes an array of onsets and returns an array
+        of the same shape holding the segment of every onset
+        '''
+        onsets = np.asarray(onsets, dtype=np.float64)
+        runs = np.searchsorted(self.startsArray, onsets, side='right') - 1
+        if runs.size > 0 and runs.min() < 0:
+            raise ValueError('onsets before the first segment')
+
+        return runs + 1
+
+    def run_onsets(self, onsets, segments):
+        '''
+        converts onsets (seconds from stimulus onset) into onsets relative
+        to the start of their segment, corrected by the segment's offset
+        '''
+        onsets = np.asarray(onsets, dtype=np.float64)
+        segments = np.asarray(segments)
+
+        return onsets - self.startsArray[segments - 1] \
+            + self.offsetsArray[segments - 1]
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+'''
+cuts 2-D planes out of 3-D volumes and composites colormapped overlays as
+RGBA arrays, so that a figure only reads and colors the planes it shows
+instead of whole (resampled) volumes
+
+the volumes need axis-aligned affines (e.g. MNI space; flips are fine)
+'''
+from functools import lru_cache
+from matplotlib import colors
+import nibabel as nib
+import numpy as np
+
+
+# display modes (as in nilearn) and the axis they cut
+AXES = {'x': 0, 'y': 1, 'z': 2}
+
+
+class Volume(object):
+    '''
+    a NIfTI image whose data are read plane by plane from its data proxy
+    (memory-mapped if the file is uncompressed); world coordinates are
+    mapped to voxel indices with the diagonal of the affine
+    '''
+
+    def __init__(self, fpath):
+        '''
+        '''
+        img = nib.load(fpath)
+        linear = img.affine[:3, :3]
+        if np.count_nonzero(linear - np.diag(np.diag(linear))):
+            raise ValueError('%s is not axis-aligned; resample it first'
+                             % fpath)
+
+        self.dataobj = img.dataobj
+        self.shape = img.shape[:3]
+        self.zooms = np.diag(linear).astype(np.float64)
+        self.origin = img.affine[:3, 3].astype(np.float64)
+
+    def coords(self, axis):
+        '''
+        world coordinates of the voxel centers along an axis (ascending)
+        '''
+        return np.sort(self.origin[axis]
+                       + self.zooms[axis] * np.arange(self.shape[axis]))
+
+    def indices(self, axis, coords):
+        '''
+        nearest voxel indices of world coordinates along an axis; -1 for
+        coordinates outside of the volume
+        '''
+        indices = np.rint((np.asarray(coords, dtype=np.float64)
+                           - self.origin[axis]) / self.zooms[axis]).astype(int)
+        indices[(indices < 0) | (indices >= self.shape[axis])] = -1
+
+        return indices
+
+    def plane(self, axis, coord):
+        '''
+        the plane of voxels at a world coordinate (None if it is outside)
+        '''
+        index = self.indices(axis, [coord])[0]
+        if index < 0:
+            return None
+
+        slicer = [slice(None)] * 3
+        slicer[axis] = index
+
+        return np.asarray(self.dataobj[tuple(slicer)], dtype=np.float64)
+
+    def sample(self, axis, coord, gridCoords):
+        '''
+        values of the plane at a world coordinate on a grid given by the
+        world coordinates of its columns and rows (the two other axes,
+        in their order); nearest neighbour, NaN outside the volume
+        '''
+        colAxis, rowAxis = [other for other in range(3) if other != axis]
+        colCoords, rowCoords = gridCoords
+        values = np.full((len(rowCoords), len(colCoords)), np.nan)
+
+        plane = self.plane(axis, coord)
+        if plane is None:
+            return values
+
+        cols = self.indices(colAxis, colCoords)
+        rows = self.indices(rowAxis, rowCoords)
+        inCols, inRows = cols >= 0, rows >= 0
+        # the plane's first axis is the column axis
+        values[np.ix_(inRows, inCols)] = plane[np.ix_(cols[inCols],
+                                                      rows[inRows])].T
+
+        return values
+
+
+@lru_cache(maxsize=None)
+def load_volume(fpath):
+    '''
+    opens a volume once (header and data proxy only)
+    '''
+    return Volume(fpath)
+
+
+def colorize(values, cmap, vmin=None, vmax=None, threshold=None, alpha=1.0):
+    '''
+    RGBA array of a plane; NaNs and values with an absolute value up to
+    the threshold are transparent; vmin and vmax default to the range of
+    the visible values
+    '''
+    hidden = np.isnan(values)
+    if threshold is not None:
+        hidden |= np.abs(np.nan_to_num(values)) <= threshold
+
+    visible = values[~hidden]
+    if vmin is None:
+        vmin = visible.min() if visible.size else 0.0
+    if vmax is None:
+        vmax = visible.max() if visible.size else 1.0
+
+    norm = colors.Normalize(vmin=vmin, vmax=vmax, clip=True)
+    rgba = cmap(norm(np.nan_to_num(values)))
+    rgba[..., 3] = np.where(hidden, 0.0, alpha)
+
+    return rgba
+
+
+def composite(layers):
+    '''
+    puts the RGBA arrays on top of each other (first = bottom layer)
+    '''
+    out = np.zeros_like(layers[0])
+    for layer in layers:
+        srcAlpha = layer[..., 3:]
+        dstAlpha = out[..., 3:] * (1 - srcAlpha)
+        alpha = srcAlpha + dstAlpha
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rgb = (layer[..., :3] * srcAlpha + out[..., :3] * dstAlpha) / alpha
+        out[..., :3] = np.where(alpha > 0, rgb, 0)
+        out[..., 3:] = alpha
+
+    return out
+
+
+def render_plane(mode, coord, layers):
+    '''
+    composites the planes of the layers at a coordinate on the grid of the
+    first layer (the background); layers is a list of (file, kwargs of
+    colorize) tuples; returns the RGBA array (rows bottom-up) and its extent
+    in world coordinates for imshow(origin='lower')
+    '''
+    axis = AXES[mode]
+    background = load_volume(layers[0][0])
+    colAxis, rowAxis = [other for other in range(3) if other != axis]
+    gridCoords = (background.coords(colAxis), background.coords(rowAxis))
+
+    rgbas = [colorize(load_volume(fpath).sample(axis, coord, gridCoords),
+                      **kwargs)
+             for fpath, kwargs in layers]
+
+    halfCol = abs(background.zooms[colAxis]) / 2
+    halfRow = abs(background.zooms[rowAxis]) / 2
+    extent = [gridCoords[0][0] - halfCol, gridCoords[0][-1] + halfCol,
+              gridCoords[1][0] - halfRow, gridCoords[1][-1] + halfRow]
+
+    return composite(rgbas), extent